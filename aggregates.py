@@ -0,0 +1,549 @@
+import os
+import threading
+from collections import OrderedDict
+from functools import cached_property
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+from bitmaps import BitmapIndex, selection_key, selection_version
+from data_loader import (
+    LAYOUT_COLUMNS,
+    RATES_PATH,
+    dataset_version,
+    group_offsets,
+    load_rates,
+    shared_array,
+)
+from sketches import RateSketch, read_sketches
+
+GROUP_COLUMNS = ("state", "age", "year")
+# Every non-empty combination of the group columns
+GROUPINGS = [
+    by
+    for n in range(1, len(GROUP_COLUMNS) + 1)
+    for by in combinations(GROUP_COLUMNS, n)
+]
+
+# Most outlier points sampled per box, to which the lowest and highest
+# outliers are added so the axis range matches the data
+MAX_OUTLIERS = 200
+
+# Rate histogram edges: a bin count or a numpy rule such as "fd"
+# (Freedman-Diaconis), capped so the figure stays small on large data
+RATE_BINS = "fd"
+MAX_RATE_BINS = 1000
+
+# Cubes of filtered rows kept per dataset, at most this many and, counting
+# the rows they copied and the rate order each sorts, this many bytes
+MAX_SELECTIONS = 16
+SELECTION_CACHE_BYTES = int(os.environ.get("SELECTION_CACHE_BYTES", 256 * 2**20))
+
+# "exact" or "approximate", which takes medians and quartiles from quantile
+# sketches, written by ingest.py or built on load
+QUANTILES = os.environ.get("QUANTILES", "exact")
+# Sketches are kept beside the parts in a dataset directory; the leading
+# underscore keeps parquet readers from taking them for data
+SKETCH_DIR = "_sketches"
+
+# "pandas" loads the rates into memory, "duckdb" queries the files on disk
+RATES_BACKEND = os.environ.get("RATES_BACKEND", "pandas")
+
+
+def group_codes(rates, by):
+    # A dense integer code per row for its combination of the by columns,
+    # and the index of keys the codes stand for
+    if not by:
+        return np.zeros(len(rates), dtype=np.int16), pd.Index([None])
+
+    codes, levels = zip(*(pd.factorize(rates[column], sort=True) for column in by))
+    shape = tuple(map(len, levels))
+    combined = np.ravel_multi_index(codes, shape) if len(by) > 1 else codes[0]
+
+    # Renumber the combinations that occur, in key order
+    present = np.flatnonzero(np.bincount(combined, minlength=np.prod(shape)))
+    dense = np.zeros(np.prod(shape), dtype=np.min_scalar_type(len(present)))
+    dense[present] = np.arange(len(present))
+
+    positions = np.unravel_index(present, shape)
+    if len(by) == 1:
+        keys = pd.Index(levels[0].take(positions[0]), name=by[0])
+    else:
+        keys = pd.MultiIndex.from_arrays(
+            [level.take(i) for level, i in zip(levels, positions)], names=by
+        )
+    return dense[combined], keys
+
+
+def layout_groups(rates, by, offsets):
+    # sorted_groups for rows laid out by data_loader.sort_rates, grouped by
+    # a prefix of the layout columns: the groups are already contiguous, so
+    # only the rates within each are sorted, and not even those for the
+    # full grouping
+    rate = rates.rate.to_numpy()
+    if by:
+        starts = offsets.start.groupby(level=list(range(len(by)))).min()
+        keys = starts.index
+        bounds = np.append(starts.to_numpy(), len(rates))
+    else:
+        keys = pd.Index([None])
+        bounds = np.array([0, len(rates)])
+
+    values = rate.astype(np.float64)
+    if len(by) < len(LAYOUT_COLUMNS):
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            values[start:end].sort()
+    return values, bounds, keys
+
+
+def sorted_groups(rates, by, order=None, offsets=None):
+    # Rates sorted by group and then by value, so every group is a
+    # contiguous ascending slice, with the slice bounds and group keys.
+    # order is the argsort of rate, which can be shared between groupings;
+    # offsets is the group_offsets of rows laid out by group.
+    if offsets is not None and tuple(by) == LAYOUT_COLUMNS[: len(by)]:
+        return layout_groups(rates, tuple(by), offsets)
+
+    codes, keys = group_codes(rates, by)
+    if order is None:
+        order = np.argsort(rates.rate.to_numpy())
+    # A stable sort of small integer codes is a radix sort in numpy
+    order = order[np.argsort(codes[order], kind="stable")]
+    values = rates.rate.to_numpy()[order].astype(np.float64)
+    bounds = np.zeros(len(keys) + 1, dtype=np.intp)
+    np.cumsum(np.bincount(codes, minlength=len(keys)), out=bounds[1:])
+    return values, bounds, keys
+
+
+def sorted_quantile(values, p, starts=0, counts=None):
+    # Linear interpolation, as numpy and plotly's default quartilemethod do,
+    # of each sorted slice values[start:start + count]
+    if counts is None:
+        counts = len(values)
+    position = p * (counts - 1)
+    lower = np.floor(position).astype(np.intp)
+    upper = np.minimum(lower + 1, counts - 1)
+    low, high = values[starts + lower], values[starts + upper]
+    return low + (high - low) * (position - lower)
+
+
+def grouped_stats(values, bounds):
+    # Every statistic of each sorted slice in one vectorised pass
+    starts, ends = bounds[:-1], bounds[1:]
+    counts = ends - starts
+    sums = np.add.reduceat(values, starts)
+    means = sums / counts
+    deviations = values - np.repeat(means, counts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        std = np.sqrt(np.add.reduceat(deviations * deviations, starts) / (counts - 1))
+    return {
+        "count": counts,
+        "sum": sums,
+        "mean": means,
+        "median": sorted_quantile(values, 0.5, starts, counts),
+        "min": values[starts],
+        "max": values[ends - 1],
+        "std": std,
+        "q1": sorted_quantile(values, 0.25, starts, counts),
+        "q3": sorted_quantile(values, 0.75, starts, counts),
+    }
+
+
+def rate_stats(rates, by, order=None, offsets=None):
+    values, bounds, keys = sorted_groups(rates, by, order, offsets)
+    return pd.DataFrame(grouped_stats(values, bounds), index=keys)
+
+
+def box_summary(
+    rates, by=None, max_outliers=MAX_OUTLIERS, seed=0, order=None, offsets=None
+):
+    values, bounds, keys = sorted_groups(rates, (by,) if by else (), order, offsets)
+    stats = grouped_stats(values, bounds)
+    iqr = stats["q3"] - stats["q1"]
+
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+        group = values[start:end]
+        low = np.searchsorted(group, stats["q1"][i] - 1.5 * iqr[i], side="left")
+        high = np.searchsorted(group, stats["q3"][i] + 1.5 * iqr[i], side="right")
+
+        outliers = np.concatenate([group[:low], group[high:]])
+        if len(outliers) > max_outliers:
+            # Keep the extreme outliers so the axis range matches the full
+            # data; the group's min or max may be inside the fences
+            sample = rng.choice(len(outliers), max_outliers, replace=False)
+            outliers = np.unique(np.concatenate([outliers[sample], outliers[[0, -1]]]))
+
+        rows.append(
+            {
+                "q1": stats["q1"][i],
+                "median": stats["median"][i],
+                "q3": stats["q3"][i],
+                "lowerfence": group[low],
+                "upperfence": group[high - 1],
+                "mean": stats["mean"][i],
+                "outliers": outliers,
+            }
+        )
+
+    return pd.DataFrame(rows, index=keys.rename(by))
+
+
+def histogram_bins(rates, column, bins=RATE_BINS):
+    # Bin on the server so figures carry one bar per bin instead of every row
+    match column:
+        case "rate":
+            values = rates.rate.to_numpy()
+            edges = np.histogram_bin_edges(values, bins)
+            if len(edges) > MAX_RATE_BINS + 1:
+                edges = np.histogram_bin_edges(values, MAX_RATE_BINS)
+            counts, edges = np.histogram(values, edges)
+            x, width = edges[:-1], np.diff(edges)
+        case "age" | "year":
+            values = rates[column].to_numpy()
+            low = values.min()
+            counts = np.bincount(values - low)
+            x, width = low + np.arange(len(counts)), 1
+        case "state":
+            state = rates.state.cat
+            counts = np.bincount(state.codes, minlength=len(state.categories))
+            x, width = state.categories.to_numpy(), None
+
+    return pd.DataFrame({"x": x, "width": width, "count": counts})
+
+
+def sketch_stats(sketch):
+    # The columns of rate_stats, with exact moments and approximate quantiles
+    moments = sketch.moments
+    counts = moments["count"]
+    mean = moments["sum"] / counts
+    variance = (moments["sumsq"] - counts * mean**2) / (counts - 1)
+    stats = pd.DataFrame(
+        {
+            "count": counts,
+            "sum": moments["sum"],
+            "mean": mean,
+            "median": sketch.quantile(0.5),
+            "min": moments["min"],
+            "max": moments["max"],
+            "std": np.sqrt(variance.clip(lower=0)),
+            "q1": sketch.quantile(0.25),
+            "q3": sketch.quantile(0.75),
+        }
+    )
+    if not sketch.by:
+        stats.index = pd.Index([None])
+    return stats
+
+
+def sketch_box_summary(sketch, max_outliers=MAX_OUTLIERS):
+    # Like box_summary, with the fences and outliers drawn at bucket points
+    stats = sketch_stats(sketch)
+    buckets = sketch.bucket_values()
+    if not sketch.by:
+        buckets.index = pd.Index([None] * len(buckets))
+
+    rows = []
+    for key, group in stats.iterrows():
+        values = buckets.loc[[key], "value"].to_numpy()
+        iqr = group.q3 - group.q1
+        inside = (values >= group.q1 - 1.5 * iqr) & (values <= group.q3 + 1.5 * iqr)
+        # Bucket points stand in for the rows in them, and the exact
+        # extremes are always drawn
+        outliers = np.unique(np.append(values[~inside], [group["min"], group["max"]]))
+        outliers = outliers[
+            (outliers < group.q1 - 1.5 * iqr) | (outliers > group.q3 + 1.5 * iqr)
+        ]
+        if len(outliers) > max_outliers:
+            keep = np.linspace(0, len(outliers) - 1, max_outliers).round()
+            outliers = outliers[keep.astype(np.intp)]
+        fences = values[inside] if inside.any() else [group.q1, group.q3]
+
+        rows.append(
+            {
+                "q1": group.q1,
+                "median": group["median"],
+                "q3": group.q3,
+                "lowerfence": max(np.min(fences), group["min"]),
+                "upperfence": min(np.max(fences), group["max"]),
+                "mean": group["mean"],
+                "outliers": outliers,
+            }
+        )
+
+    by = sketch.by[0] if sketch.by else None
+    return pd.DataFrame(rows, index=stats.index.rename(by))
+
+
+class RateCube:
+    # Statistics of rate for every grouping, each computed once per dataset
+    # on first use (or all at once by warm)
+
+    def __init__(
+        self, rates, quantiles=QUANTILES, sketches=None, version=None, shared=True
+    ):
+        self.rates = rates
+        # A content hash, unless the caller already knows the version
+        self.version = version or dataset_version(rates)
+        self.quantiles = quantiles
+        # Whether derived arrays are published for other processes to map
+        self.shared = shared
+        self.sketches = dict(sketches or {})
+        self.stats = {}
+        self.boxes = {}
+        # Bytes of rows copied from a parent cube, none for a view of its rows
+        self.copied_bytes = 0
+        self.selections = OrderedDict()
+        self.selections_size = 0
+        self.lock = threading.Lock()
+
+    def sketch(self, by):
+        if by not in self.sketches:
+            self.sketches[by] = RateSketch.from_rates(self.rates, by)
+        return self.sketches[by]
+
+    # Bound on the relative error of medians and quartiles, 0 when exact
+    @property
+    def quantile_error(self):
+        if self.quantiles == "approximate":
+            return self.sketch(()).alpha
+        return 0
+
+    # Rows in ascending rate order, sorted once and shared by every grouping
+    # (and by every process, with a shared directory)
+    @cached_property
+    def rate_order(self):
+        order = lambda: np.argsort(self.rates.rate.to_numpy()).astype(np.int32)
+        if self.shared:
+            return shared_array("rate_order", self.version, order)
+        return order()
+
+    # Where each group's rows are, if the rows are laid out by group
+    @cached_property
+    def offsets(self):
+        return group_offsets(self.rates)
+
+    def compute_stats(self, by):
+        if self.quantiles == "approximate":
+            return sketch_stats(self.sketch(by))
+        if self.offsets is not None and by == LAYOUT_COLUMNS[: len(by)]:
+            return rate_stats(self.rates, by, offsets=self.offsets)
+        return rate_stats(self.rates, by, self.rate_order)
+
+    def compute_box(self, by):
+        if self.quantiles == "approximate":
+            return sketch_box_summary(self.sketch((by,) if by else ()))
+        if self.offsets is not None and by in (None, LAYOUT_COLUMNS[0]):
+            return box_summary(self.rates, by, offsets=self.offsets)
+        return box_summary(self.rates, by, order=self.rate_order)
+
+    def group_rates(self, *key):
+        # The rates of one group of a prefix of the layout columns, e.g.
+        # group_rates("NY") or group_rates("NY", 30), as a view of the
+        # group's rows when they are laid out by group
+        if self.offsets is None:
+            mask = np.logical_and.reduce(
+                [
+                    self.rates[column] == value
+                    for column, value in zip(LAYOUT_COLUMNS, key)
+                ]
+            )
+            return self.rates.rate.to_numpy()[mask]
+        rate = self.rates.rate.to_numpy()
+        try:
+            rows = self.offsets.loc[key]
+        except KeyError:
+            return rate[:0]
+        return rate[np.min(rows["start"]) : np.max(rows["stop"])]
+
+    @cached_property
+    def histograms(self):
+        return {
+            column: histogram_bins(self.rates, column)
+            for column in ("rate", *GROUP_COLUMNS)
+        }
+
+    # States in ascending median and count order
+    @cached_property
+    def state_order(self):
+        return self.get("state")["median"].sort_values().index.tolist()
+
+    @cached_property
+    def state_count_order(self):
+        return self.get("state")["count"].sort_values().index.tolist()
+
+    @cached_property
+    def bitmaps(self):
+        return BitmapIndex(self.rates, GROUP_COLUMNS, self.version)
+
+    # Every state, and the lowest and highest year and age, read from the
+    # columns rather than the statistics so they cost little before warm
+    @cached_property
+    def bounds(self):
+        state = self.rates.state
+        if isinstance(state.dtype, pd.CategoricalDtype):
+            counts = np.bincount(
+                state.cat.codes.to_numpy(), minlength=len(state.cat.categories)
+            )
+            states = state.cat.categories[counts > 0]
+        else:
+            states = pd.unique(state)
+        years, ages = self.rates.year.to_numpy(), self.rates.age.to_numpy()
+        return (
+            sorted(map(str, states)),
+            (int(years.min()), int(years.max())),
+            (int(ages.min()), int(ages.max())),
+        )
+
+    def warm(self):
+        for by in GROUPINGS:
+            self.get(*by)
+        for by in (None, *GROUP_COLUMNS):
+            self.box(by)
+        self.histograms, self.state_order, self.state_count_order
+        return self
+
+    def get(self, *by):
+        if by not in self.stats:
+            self.stats[by] = self.compute_stats(by)
+        return self.stats[by]
+
+    def box(self, by=None):
+        if by not in self.boxes:
+            self.boxes[by] = self.compute_box(by)
+        return self.boxes[by]
+
+    def histogram(self, column):
+        return self.histograms[column]
+
+    def select(self, selection):
+        # The cube of the rows whose state, year and age are among the
+        # selected values, e.g. {"state": ["NY"], "age": range(20, 31)},
+        # or None if no row is. The latest selections' cubes are kept.
+        key = selection_key(selection)
+        if not key:
+            return self
+        with self.lock:
+            if key in self.selections:
+                self.selections.move_to_end(key)
+                return self.selections[key][0]
+
+        cube = self.selected_cube(dict(key))
+        size = selection_bytes(cube)
+        with self.lock:
+            old = self.selections.pop(key, None)
+            if old is not None:
+                self.selections_size -= old[1]
+            self.selections[key] = cube, size
+            self.selections_size += size
+            while len(self.selections) > 1 and (
+                len(self.selections) > MAX_SELECTIONS
+                or self.selections_size > SELECTION_CACHE_BYTES
+            ):
+                _, (_, evicted) = self.selections.popitem(last=False)
+                self.selections_size -= evicted
+        return cube
+
+    def selected_version(self, selection):
+        # The version of select(selection)'s cube, without selecting, for
+        # looking up what was rendered from it
+        if not selection_key(selection):
+            return self.version
+        return selection_version(self.version, selection)
+
+    def selected_cube(self, selection):
+        if self.offsets is not None:
+            return self.selected_runs(selection)
+        rows = self.bitmaps.rows(selection)
+        if not len(rows):
+            return None
+        version = selection_version(self.version, selection)
+        cube = RateCube(
+            self.rates.take(rows), self.quantiles, version=version, shared=False
+        )
+        cube.copied_bytes = row_bytes(cube.rates)
+        return cube
+
+    def selected_runs(self, selection):
+        # selected_cube of rows laid out by group: every selected value of
+        # the layout columns picks whole groups, so the rows are found from
+        # the group offsets without the bitmaps. Rows in one run, such as a
+        # single state's, are a view rather than a copy, and stay laid out
+        # either way.
+        keys = self.offsets.index
+        keep = np.logical_and.reduce(
+            [
+                keys.get_level_values(column).isin(list(values))
+                for column, values in selection.items()
+                if values is not None
+            ]
+            + [np.ones(len(keys), dtype=bool)]
+        )
+        starts = self.offsets.start.to_numpy()[keep]
+        stops = self.offsets.stop.to_numpy()[keep]
+        if not len(starts):
+            return None
+        # Adjacent groups make one run
+        new_run = np.append(True, starts[1:] != stops[:-1])
+        starts, stops = starts[new_run], stops[np.append(new_run[1:], True)]
+
+        version = selection_version(self.version, selection)
+        if len(starts) == 1:
+            rates = self.rates.iloc[starts[0] : stops[0]]
+            return RateCube(rates, self.quantiles, version=version, shared=False)
+        lengths = stops - starts
+        first = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        rows = first + np.arange(lengths.sum())
+        cube = RateCube(
+            self.rates.take(rows), self.quantiles, version=version, shared=False
+        )
+        cube.copied_bytes = row_bytes(cube.rates)
+        return cube
+
+
+def row_bytes(rates):
+    return int(rates.memory_usage(index=False).sum())
+
+
+def selection_bytes(cube):
+    # What a cached selection holds on to: the rows it copied, and the
+    # rate order it sorts for groupings other than the layout's
+    if cube is None or cube.rates is None:
+        return 0
+    return cube.copied_bytes + 4 * len(cube.rates)
+
+
+def filter_bounds(cube):
+    # Every state, and the lowest and highest year and age, to filter by
+    return cube.bounds
+
+
+def filter_selection(cube, states=(), years=(None, None), ages=(None, None)):
+    # A selection for cube.select from a list of states and inclusive
+    # (low, high) ranges of years and ages, leaving out filters that keep
+    # every row
+    _, *bounds = filter_bounds(cube)
+    selection = {"state": list(states) or None}
+    for column, (low, high), full in zip(("year", "age"), (years, ages), bounds):
+        if (low, high) == (None, None) or (low <= full[0] and high >= full[1]):
+            selection[column] = None
+        else:
+            selection[column] = list(range(int(low), int(high) + 1))
+    return selection
+
+
+def open_cube(path=RATES_PATH, quantiles=QUANTILES, backend=RATES_BACKEND):
+    if backend == "duckdb":
+        # Imported here so DuckDB is only needed by those who use it
+        from duckdb_cube import DuckDBCube
+
+        return DuckDBCube(path, quantiles)
+
+    # Uses the sketches ingest.py wrote for a dataset directory, if any
+    sketches = None
+    sketch_dir = os.path.join(path, SKETCH_DIR)
+    if quantiles == "approximate" and os.path.isdir(sketch_dir):
+        sketches = read_sketches(sketch_dir)
+    return RateCube(load_rates(path), quantiles, sketches)
@@ -0,0 +1,208 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from aggregates import GROUP_COLUMNS, open_cube
+from data_loader import RATES_PATH
+from figure_cache import FigureCache
+from metrics import METRICS
+from reload import RELOAD_SECONDS, DatasetWatcher
+from render import render_version
+
+# Encoded responses kept per dataset version, so repeated polls are only a
+# lookup, or nothing at all when the client already has the response
+API_CACHE_BYTES = int(os.environ.get("API_CACHE_BYTES", 16 * 2**20))
+
+STATISTICS = ("count", "sum", "mean", "median", "min", "max", "std", "q1", "q3")
+HISTOGRAM_COLUMNS = ("rate", *GROUP_COLUMNS)
+CONTENT_TYPE = "application/json"
+
+
+def values(params, name):
+    # Repeated and comma-separated values alike, e.g. by=state&by=age or
+    # by=state,age
+    return [
+        value for param in params.get(name, []) for value in param.split(",") if value
+    ]
+
+
+def stats_payload(cube, params):
+    by = values(params, "by")
+    unknown = set(by) - set(GROUP_COLUMNS)
+    if unknown:
+        raise ValueError(f"Cannot group by {', '.join(sorted(unknown))}")
+    # In the cube's own order, which any sketches were written in
+    by = tuple(column for column in GROUP_COLUMNS if column in by)
+
+    statistics = values(params, "statistic") or list(STATISTICS)
+    unknown = set(statistics) - set(STATISTICS)
+    if unknown:
+        raise ValueError(f"Unknown statistic {', '.join(sorted(unknown))}")
+
+    stats = cube.get(*by)[statistics]
+    # Everything but the count is in dollars, so cents are all the precision
+    # worth sending, and the rest is float32 noise
+    dollars = [statistic for statistic in statistics if statistic != "count"]
+    stats = stats.astype({statistic: "float64" for statistic in dollars})
+    stats[dollars] = stats[dollars].round(2)
+    groups = stats.reset_index() if by else stats.reset_index(drop=True)
+    return {
+        "version": cube.version,
+        "by": list(by),
+        "statistics": statistics,
+        "quantile_error": cube.quantile_error,
+        "groups": json.loads(groups.to_json(orient="records")),
+    }
+
+
+def histogram_payload(cube, params):
+    column = (values(params, "column") or ["rate"])[0]
+    if column not in HISTOGRAM_COLUMNS:
+        raise ValueError(f"No histogram of {column}")
+    bins = cube.histogram(column)
+    if column == "rate":
+        bins = bins.astype({"x": "float64", "width": "float64"}).round(
+            {"x": 2, "width": 2}
+        )
+    return {
+        "version": cube.version,
+        "column": column,
+        "bins": json.loads(bins.to_json(orient="records")),
+    }
+
+
+ENDPOINTS = {"/stats": stats_payload, "/histogram": histogram_payload}
+
+
+def entity_tag(version, path, query, gzipped):
+    # Strong, and the same for any order of the query parameters; the
+    # compressed body is a different representation, so it has its own tag
+    canonical = f"{path}?{urlencode(sorted(parse_qsl(query)))}"
+    digest = hashlib.blake2b(canonical.encode(), digest_size=8).hexdigest()
+    return f'"{version}-{digest}{"-gzip" if gzipped else ""}"'
+
+
+def accepts_gzip(header):
+    for coding in header.split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip() == "gzip":
+            return params.replace(" ", "") not in ("q=0", "q=0.0")
+    return False
+
+
+def matches(header, tag):
+    # Weak comparison, as If-None-Match uses
+    if header.strip() == "*":
+        return True
+    return tag in (
+        candidate.strip().removeprefix("W/") for candidate in header.split(",")
+    )
+
+
+def make_server(get_cube, port, host="0.0.0.0"):
+    # Read-only JSON API over the cube get_cube returns, looked up on each
+    # request so reloaded datasets are picked up
+    cache = FigureCache(API_CACHE_BYTES)
+    # The statistics depend on the aggregation code and quantile mode too
+    code_version = render_version()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            payload = ENDPOINTS.get(url.path)
+            if payload is None:
+                self.send_json(404, {"error": f"No endpoint {url.path}"})
+                return
+
+            cube = get_cube()
+            gzipped = accepts_gzip(self.headers.get("Accept-Encoding", ""))
+            version = f"{cube.version}-{code_version}"
+            tag = entity_tag(version, url.path, url.query, gzipped)
+            endpoint = url.path.strip("/")
+            if matches(self.headers.get("If-None-Match", ""), tag):
+                METRICS.inc("api_requests_total", endpoint=endpoint, status="304")
+                self.send_response(304)
+                self.send_cache_headers(tag)
+                self.end_headers()
+                return
+
+            body = cache.get(tag)
+            if body is None:
+                params = {}
+                for name, value in parse_qsl(url.query):
+                    params.setdefault(name, []).append(value)
+                try:
+                    result = payload(cube, params)
+                except ValueError as error:
+                    METRICS.inc("api_requests_total", endpoint=endpoint, status="400")
+                    self.send_json(400, {"error": str(error)})
+                    return
+                body = json.dumps(result, separators=(",", ":")).encode()
+                if gzipped:
+                    body = gzip.compress(body, mtime=0)
+                cache.put(tag, body)
+
+            METRICS.inc("api_requests_total", endpoint=endpoint, status="200")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            if gzipped:
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_cache_headers(tag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_cache_headers(self, tag):
+            self.send_header("ETag", tag)
+            # Clients may keep responses but must check they are current,
+            # which costs a 304 when they are
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Vary", "Accept-Encoding")
+
+        def send_json(self, status, result):
+            body = json.dumps(result).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def serve_api(get_cube, port, host="0.0.0.0"):
+    # Served from a daemon thread, alongside an app
+    server = make_server(get_cube, port, host)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve grouped rate statistics and histograms as JSON"
+    )
+    parser.add_argument("--data", default=RATES_PATH)
+    parser.add_argument("--port", type=int, default=os.environ.get("API_PORT", 8080))
+    parser.add_argument("--host", default="0.0.0.0")
+    args = parser.parse_args()
+
+    watcher = DatasetWatcher(args.data)
+    cube = open_cube(args.data).warm()
+    if RELOAD_SECONDS:
+        watcher.start(cube, lambda old, new: None)
+    else:
+        watcher.cube = cube
+    print(f"Serving {args.data} on http://{args.host}:{args.port}/stats")
+    make_server(lambda: watcher.cube, args.port, args.host).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
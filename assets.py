@@ -0,0 +1,44 @@
+import argparse
+import os
+
+from plotly.offline import get_plotlyjs, get_plotlyjs_version
+
+# Served by waved with H2O_WAVE_PUBLIC_DIR="/assets/@./static"
+ASSETS_DIR = os.environ.get("ASSETS_DIR", "static")
+ASSETS_URL = "/assets/"
+
+
+def plotlyjs_name():
+    # Versioned so browsers can cache it forever
+    return f"plotly-{get_plotlyjs_version()}.min.js"
+
+
+def plotlyjs_url():
+    return ASSETS_URL + plotlyjs_name()
+
+
+def write_plotlyjs(assets_dir=ASSETS_DIR):
+    path = os.path.join(assets_dir, plotlyjs_name())
+    if not os.path.exists(path):
+        os.makedirs(assets_dir, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(get_plotlyjs())
+        os.replace(tmp_path, path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write the plotly.js bundle that chart frames load locally"
+    )
+    parser.add_argument("--out", default=ASSETS_DIR)
+    args = parser.parse_args()
+
+    path = write_plotlyjs(args.out)
+    print(f"Wrote {path}; serve it with")
+    print(f'  H2O_WAVE_PUBLIC_DIR="{ASSETS_URL}@{args.out}" PLOTLYJS=local')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from benchmarks.run import RESULTS_DIR, git_commit
+from render import CHOICES
+
+# Simulated clients speak Wave's websocket protocol to the Wave server,
+# which relays their events to the app like a browser's
+WAVE_ADDRESS = os.environ.get("H2O_WAVE_ADDRESS", "http://127.0.0.1:10101")
+ROUTE = "/insurance_full"
+APP_PORT = 8000
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds to wait for the app to answer a first visit, including its startup
+STARTUP_TIMEOUT = 120
+RESPONSE_TIMEOUT = 30
+# Every interaction the app labels its own request metrics with
+INTERACTIONS = ("page", *CHOICES)
+PERCENTILES = (50, 95, 99)
+
+
+def socket_url(address):
+    return address.replace("http", "ws", 1).rstrip("/") + "/_s/"
+
+
+async def receive_update(ws, timeout=RESPONSE_TIMEOUT):
+    # Waits for the page (on a first visit) or page changes an event caused,
+    # and returns them
+    while True:
+        message = await asyncio.wait_for(ws.recv(), timeout)
+        for line in message.splitlines():
+            if not line:
+                continue
+            data = json.loads(line)
+            if "e" in data:
+                raise RuntimeError(f"Wave server error: {data['e']}")
+            if "p" in data or "d" in data:
+                return data.get("d") or []
+
+
+def input_values(changes):
+    # The value of every input on a page, as the browser sends them with
+    # each event, e.g. the filters' selected states and ranges
+    values = {}
+    for change in changes:
+        card = change.get("d") if isinstance(change, dict) else None
+        for item in (card or {}).get("items", []):
+            for kind, component in item.items():
+                if not isinstance(component, dict) or "name" not in component:
+                    continue
+                if kind == "range_slider":
+                    values[component["name"]] = [
+                        component["min_value"],
+                        component["max_value"],
+                    ]
+                elif "values" in component:
+                    values[component["name"]] = component["values"]
+                elif "value" in component:
+                    values[component["name"]] = component["value"]
+    return values
+
+
+def next_event(rng, state, inputs):
+    # A dropdown change or a route change to a choice not already shown,
+    # with every input's value and the current route, as the browser sends
+    # them
+    chart = rng.choice(list(CHOICES))
+    choice = rng.choice([c for c in CHOICES[chart] if c != state[chart]])
+    state[chart] = choice
+    if chart in ("line", "map"):
+        state["#"] = f"{chart}/{choice}"
+    else:
+        inputs[f"choice_{chart}"] = choice
+    args = dict(inputs)
+    if state["#"]:
+        args["#"] = state["#"]
+    return chart, args
+
+
+async def run_client(connect, url, route, deadline, think, rng, samples, errors):
+    state = {"hist": "rate", "box": "none", "line": "age", "map": "median", "#": None}
+    try:
+        async with connect(url, max_size=None) as ws:
+            start = time.perf_counter()
+            await ws.send(f"+ {route} ")
+            inputs = input_values(await receive_update(ws))
+            samples["page"].append(time.perf_counter() - start)
+
+            while time.monotonic() < deadline:
+                if think:
+                    await asyncio.sleep(rng.expovariate(1 / think))
+                interaction, args = next_event(rng, state, inputs)
+                start = time.perf_counter()
+                await ws.send(f"@ {route} {json.dumps(args)}")
+                await receive_update(ws)
+                samples[interaction].append(time.perf_counter() - start)
+    except Exception as error:
+        # Timeouts, server errors and closed connections end the client
+        errors.append(f"{type(error).__name__}: {error}")
+
+
+def process_tree(pid):
+    # pid and every process descended from it, e.g. render pool workers
+    parents = {}
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    fields = f.read().rpartition(")")[2].split()
+                parents.setdefault(int(fields[1]), []).append(int(name))
+            except OSError:
+                pass
+    tree, stack = [], [pid]
+    while stack:
+        tree.append(stack.pop())
+        stack.extend(parents.get(tree[-1], []))
+    return tree
+
+
+def cpu_seconds(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rpartition(")")[2].split()
+        except OSError:
+            continue
+        # utime and stime, in clock ticks
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+def rss_bytes(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+async def sample_resources(pid, samples, interval=0.5):
+    while True:
+        samples.append(rss_bytes(process_tree(pid)))
+        await asyncio.sleep(interval)
+
+
+def latency_summary(values):
+    if not values:
+        return {"count": 0}
+    percentiles = np.percentile(values, PERCENTILES)
+    return {
+        "count": len(values),
+        "mean": float(np.mean(values)),
+        **{f"p{p}": float(v) for p, v in zip(PERCENTILES, percentiles)},
+        "max": float(np.max(values)),
+    }
+
+
+async def run_level(connect, url, route, n_clients, duration, think, pid, seed):
+    samples = {interaction: [] for interaction in INTERACTIONS}
+    errors, rss = [], []
+    sampler = asyncio.ensure_future(sample_resources(pid, rss))
+    cpu_start, start = cpu_seconds(process_tree(pid)), time.perf_counter()
+
+    deadline = time.monotonic() + duration
+    await asyncio.gather(
+        *(
+            run_client(
+                connect,
+                url,
+                route,
+                deadline,
+                think,
+                random.Random(seed + i),
+                samples,
+                errors,
+            )
+            for i in range(n_clients)
+        )
+    )
+
+    elapsed = time.perf_counter() - start
+    cpu = cpu_seconds(process_tree(pid)) - cpu_start
+    sampler.cancel()
+    requests = sum(map(len, samples.values()))
+    return {
+        "clients": n_clients,
+        "seconds": elapsed,
+        "requests": requests,
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "throughput": requests / elapsed,
+        "cpu_seconds": cpu,
+        # Cores the app kept busy on average
+        "cpu_utilisation": cpu / elapsed,
+        "rss_peak_bytes": max(rss, default=0),
+        "rss_mean_bytes": int(np.mean(rss)) if rss else 0,
+        "latency": {name: latency_summary(values) for name, values in samples.items()},
+    }
+
+
+def start_app(port):
+    env = dict(os.environ, H2O_WAVE_APP_ADDRESS=f"http://127.0.0.1:{port}")
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "insurance_app_full:main",
+            "--port",
+            str(port),
+        ],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+async def wait_for_app(connect, url, route):
+    # The first visit also loads the data, so it is timed separately from
+    # the load levels
+    start = time.perf_counter()
+    while True:
+        try:
+            async with connect(url, max_size=None) as ws:
+                await ws.send(f"+ {route} ")
+                await receive_update(ws, STARTUP_TIMEOUT)
+                return time.perf_counter() - start
+        except Exception:
+            if time.perf_counter() - start > STARTUP_TIMEOUT:
+                raise
+            await asyncio.sleep(1)
+
+
+async def load_test(levels, duration, think, address, route, pid, port, seed):
+    # Imported here so only load testing needs websockets
+    from websockets.asyncio.client import connect
+
+    url = socket_url(address)
+    app = None
+    if pid is None:
+        app = start_app(port)
+        pid = app.pid
+    try:
+        startup = await wait_for_app(connect, url, route)
+        results = []
+        for n_clients in levels:
+            result = await run_level(
+                connect, url, route, n_clients, duration, think, pid, seed
+            )
+            results.append(result)
+            page, route_change = result["latency"]["page"], result["latency"]["map"]
+            print(
+                f"{n_clients:>5} clients {result['throughput']:>8.1f} req/s "
+                f"map p95 {route_change.get('p95', 0) * 1000:>8.1f} ms "
+                f"page p95 {page.get('p95', 0) * 1000:>8.1f} ms "
+                f"cpu {result['cpu_utilisation']:>5.2f} "
+                f"rss {result['rss_peak_bytes'] / 2**20:>7.1f} MB "
+                f"errors {result['errors']}"
+            )
+    finally:
+        if app is not None:
+            app.terminate()
+            app.wait()
+
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "route": route,
+        "duration": duration,
+        "think_seconds": think,
+        "startup_seconds": startup,
+        "levels": results,
+    }
+
+
+def compare(base_path, new_path):
+    with open(base_path) as f:
+        base = {level["clients"]: level for level in json.load(f)["levels"]}
+    with open(new_path) as f:
+        new = json.load(f)["levels"]
+
+    print(f"{'clients':>7} {'interaction':<12} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for level in new:
+        old = base.get(level["clients"])
+        if old is None:
+            continue
+        ratio = lambda key: level[key] / old[key] if old[key] else float("nan")
+        print(
+            f"{level['clients']:>7} {'throughput':<12} x{ratio('throughput'):.2f}, "
+            f"cpu x{ratio('cpu_seconds'):.2f}, rss x{ratio('rss_peak_bytes'):.2f}"
+        )
+        for name, latency in level["latency"].items():
+            before = old["latency"].get(name, {})
+            cells = [
+                (
+                    f"x{latency[f'p{p}'] / before[f'p{p}']:.2f}"
+                    if before.get(f"p{p}") and f"p{p}" in latency
+                    else "-"
+                )
+                for p in PERCENTILES
+            ]
+            print(
+                f"{level['clients']:>7} {name:<12} "
+                + " ".join(f"{c:>8}" for c in cells)
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate concurrent dashboard users against a local Wave app"
+    )
+    parser.add_argument(
+        "--clients", type=int, nargs="+", default=[1, 10, 25, 50], help="load levels"
+    )
+    parser.add_argument("--duration", type=float, default=30, help="seconds per level")
+    parser.add_argument(
+        "--think", type=float, default=1.0, help="mean seconds between a user's events"
+    )
+    parser.add_argument("--wave", default=WAVE_ADDRESS, help="Wave server address")
+    parser.add_argument("--route", default=ROUTE)
+    parser.add_argument(
+        "--pid", type=int, help="measure this running app instead of starting one"
+    )
+    parser.add_argument("--port", type=int, default=APP_PORT, help="for a started app")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--out", help="defaults to benchmarks/results/load-<commit>.json"
+    )
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BASE", "NEW"),
+        help="compare two result files instead of running",
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = asyncio.run(
+        load_test(
+            args.clients,
+            args.duration,
+            args.think,
+            args.wave,
+            args.route,
+            args.pid,
+            args.port,
+            args.seed,
+        )
+    )
+    out = args.out or os.path.join(RESULTS_DIR, f"load-{report['commit']}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {out}")
+
+
+if __name__ == "__main__":
+    main()
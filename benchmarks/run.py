@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from statistics import median
+
+import numpy as np
+import pandas as pd
+import plotly
+from plotly import io as pio
+
+from aggregates import GROUP_COLUMNS, GROUPINGS, RateCube
+from aggregates import box_summary, histogram_bins, rate_stats
+from benchmarks.synthetic import synthetic_rates, synthetic_raw
+from data_loader import group_offsets, preprocess_df, sort_rates
+from figures import to_html
+from render import CHARTS, all_figures
+
+SCALES = [200_000, 2_000_000, 20_000_000]
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+
+    # Separate run for memory, since tracing slows everything down
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timing = {
+        "seconds": min(times),
+        "median_seconds": median(times),
+        "peak_bytes": peak,
+    }
+    return result, timing
+
+
+def bench_scale(n_rows, repeat):
+    results = []
+
+    def record(stage, chart, choice, func, frontend=None):
+        result, timing = measure(func, repeat)
+        row = dict(rows=n_rows, stage=stage, chart=chart, choice=choice, **timing)
+        if frontend is not None:
+            row["frontend"] = frontend
+        if isinstance(result, str):
+            row["output_bytes"] = len(result)
+        results.append(row)
+        print(
+            f"{n_rows:>10,} {stage:<10} {chart:<10} {str(choice):<16} "
+            f"{frontend or '':<10} {timing['seconds'] * 1000:>10.2f} ms"
+        )
+        return result
+
+    raw = synthetic_raw(n_rows)
+    record("preprocess", "raw", None, lambda: preprocess_df(raw))
+    del raw
+
+    # Laid out by group, as the apps load it
+    rates = synthetic_rates(n_rows)
+    rates = record("preprocess", "layout", None, lambda: sort_rates(rates))
+    offsets = record("preprocess", "offsets", None, lambda: group_offsets(rates))
+    for by in GROUPINGS:
+        record(
+            "aggregate",
+            "stats",
+            "+".join(by),
+            lambda: rate_stats(rates, by, offsets=offsets),
+        )
+    for by in (None, *GROUP_COLUMNS):
+        record("aggregate", "box", by, lambda: box_summary(rates, by, offsets=offsets))
+    for column in ("rate", *GROUP_COLUMNS):
+        record("aggregate", "hist", column, lambda: histogram_bins(rates, column))
+
+    cube = RateCube(rates).warm()
+    for chart, choice in all_figures():
+        build = CHARTS[chart]
+        fig = record("figure", chart, choice, lambda: build(cube, choice))
+        # The Wave app ships HTML pages, Streamlit ships figure JSON
+        record("serialise", chart, choice, lambda: to_html(fig), "wave")
+        record(
+            "serialise",
+            chart,
+            choice,
+            lambda: pio.to_json(fig, validate=False),
+            "streamlit",
+        )
+
+    return results
+
+
+def git_commit():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(scales, repeat):
+    results = []
+    for n_rows in scales:
+        results.extend(bench_scale(n_rows, repeat))
+
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "versions": {
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "plotly": plotly.__version__,
+        },
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def result_key(row):
+    return (
+        row["rows"],
+        row["stage"],
+        row["chart"],
+        row["choice"],
+        row.get("frontend"),
+    )
+
+
+def compare(base_path, new_path):
+    with open(base_path) as f:
+        base = {result_key(row): row for row in json.load(f)["results"]}
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+
+    print(f"{'rows':>10} {'stage':<10} {'chart':<10} {'choice':<16} {'frontend':<10}")
+    for row in new:
+        old = base.get(result_key(row))
+        if old is None:
+            continue
+        ratio = row["seconds"] / old["seconds"] if old["seconds"] else float("nan")
+        memory = row["peak_bytes"] / old["peak_bytes"] if old["peak_bytes"] else 1
+        print(
+            f"{row['rows']:>10,} {row['stage']:<10} {row['chart']:<10} "
+            f"{str(row['choice']):<16} {row.get('frontend') or '':<10} "
+            f"time x{ratio:.2f} memory x{memory:.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time aggregation, figure building and serialisation"
+    )
+    parser.add_argument("--rows", type=int, nargs="+", default=SCALES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--out", help="defaults to benchmarks/results/<commit>.json")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BASE", "NEW"),
+        help="compare two result files instead of running",
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run(args.rows, args.repeat)
+    out = args.out or os.path.join(RESULTS_DIR, f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from aggregates import RateCube
+from data_loader import RATES_PATH, load_rates
+from figures import encode_figure
+from render import CHARTS, all_figures
+from plotly.utils import PlotlyJSONEncoder
+
+ENCODINGS = ("plain", "compact")
+
+# Parses each figure the way plotly.js receives it: JSON.parse, then turning
+# every typed array spec into a TypedArray
+NODE_PARSE = """
+const fs = require("fs");
+const TYPES = {i1: Int8Array, u1: Uint8Array, i2: Int16Array, u2: Uint16Array,
+               i4: Int32Array, u4: Uint32Array, f4: Float32Array, f8: Float64Array};
+const decode = (v) => {
+  if (Array.isArray(v)) return v.map(decode);
+  if (v && typeof v === "object") {
+    if (v.bdata !== undefined) {
+      const buf = Buffer.from(v.bdata, "base64");
+      return new TYPES[v.dtype](buf.buffer, buf.byteOffset, buf.length / TYPES[v.dtype].BYTES_PER_ELEMENT);
+    }
+    for (const k in v) v[k] = decode(v[k]);
+  }
+  return v;
+};
+const [path, repeat] = [process.argv[2], Number(process.argv[3])];
+const figures = JSON.parse(fs.readFileSync(path, "utf8"));
+const times = {};
+for (const key in figures) {
+  const samples = [];
+  for (let i = 0; i < repeat; i++) {
+    const start = process.hrtime.bigint();
+    decode(JSON.parse(figures[key]));
+    samples.push(Number(process.hrtime.bigint() - start) / 1e6);
+  }
+  samples.sort((a, b) => a - b);
+  times[key] = samples[Math.floor(samples.length / 2)];
+}
+console.log(JSON.stringify(times));
+"""
+
+
+def node_parse_ms(payloads, repeat):
+    # Median parse time per figure in milliseconds, or None without node
+    node = shutil.which("node")
+    if node is None:
+        return {key: None for key in payloads}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        script, data = os.path.join(tmp, "parse.js"), os.path.join(tmp, "figs.json")
+        with open(script, "w") as f:
+            f.write(NODE_PARSE)
+        with open(data, "w") as f:
+            json.dump(payloads, f)
+        out = subprocess.run(
+            [node, script, data, str(repeat)], capture_output=True, check=True
+        )
+    return json.loads(out.stdout)
+
+
+def run(cube, repeat):
+    results = []
+    payloads = {}
+    for chart, choice in all_figures():
+        fig = CHARTS[chart](cube, choice)
+        for encoding in ENCODINGS:
+            start = time.perf_counter()
+            payload = json.dumps(encode_figure(fig, encoding), cls=PlotlyJSONEncoder)
+            encode_ms = (time.perf_counter() - start) * 1000
+            key = f"{chart}/{choice}/{encoding}"
+            payloads[key] = payload
+            results.append(
+                {
+                    "chart": chart,
+                    "choice": choice,
+                    "encoding": encoding,
+                    "json_bytes": len(payload),
+                    "encode_ms": encode_ms,
+                }
+            )
+
+    parse_ms = node_parse_ms(payloads, repeat)
+    for result in results:
+        key = f"{result['chart']}/{result['choice']}/{result['encoding']}"
+        result["parse_ms"] = parse_ms[key]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare figure size and parse time for each encoding"
+    )
+    parser.add_argument("--data", default=RATES_PATH)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--out", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run(RateCube(load_rates(args.data)), args.repeat)
+
+    print(f"{'figure':<16} {'encoding':<8} {'bytes':>9} {'parse ms':>9}")
+    for r in results:
+        parse = f"{r['parse_ms']:.3f}" if r["parse_ms"] is not None else "n/a"
+        print(
+            f"{r['chart'] + '/' + r['choice']:<16} {r['encoding']:<8} "
+            f"{r['json_bytes']:>9,} {parse:>9}"
+        )
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+from data_loader import DTYPES
+
+# The 39 states on the federal marketplace in the Kaggle data, weighted
+# roughly by their share of rows
+# fmt: off
+STATES = {
+    "AK": 0.5, "AL": 1.5, "AR": 1.5, "AZ": 3.5, "DE": 0.5, "FL": 6.0,
+    "GA": 3.5, "HI": 0.5, "IA": 1.5, "ID": 1.0, "IL": 4.0, "IN": 3.0,
+    "KS": 1.5, "LA": 2.0, "ME": 1.0, "MI": 5.5, "MO": 2.5, "MS": 1.0,
+    "MT": 1.0, "NC": 2.0, "ND": 1.0, "NE": 1.5, "NH": 1.0, "NJ": 2.0,
+    "NM": 1.0, "NV": 1.5, "OH": 5.5, "OK": 2.0, "OR": 2.5, "PA": 4.5,
+    "SC": 1.5, "SD": 1.0, "TN": 2.0, "TX": 7.5, "UT": 2.0, "VA": 3.5,
+    "WI": 5.5, "WV": 1.0, "WY": 0.5,
+}
+# fmt: on
+YEARS = {2014: 0.28, 2015: 0.36, 2016: 0.36}
+AGES = np.arange(20, 66)
+# Share of rows that are plans priced far above everything else
+OUTLIER_SHARE = 0.01
+
+
+def synthetic_rates(n_rows, seed=0):
+    # Preprocessed rows: the ACA age curve over a lognormal per-state price
+    rng = np.random.default_rng(seed)
+    states = np.array(list(STATES))
+    state_weights = np.array(list(STATES.values()))
+    state_codes = rng.choice(len(states), n_rows, p=state_weights / state_weights.sum())
+    year = rng.choice(list(YEARS), n_rows, p=list(YEARS.values()))
+    age = rng.choice(AGES, n_rows)
+
+    state_price = rng.uniform(220, 420, len(states))[state_codes]
+    age_curve = 1 + 2 * ((age - 20) / 45) ** 2
+    rate = rng.lognormal(0, 0.35, n_rows) * state_price * age_curve
+    rate *= 1 + 0.04 * (year - 2014)
+    outliers = rng.random(n_rows) < OUTLIER_SHARE
+    rate[outliers] = rng.uniform(1500, 9998, outliers.sum())
+
+    return pd.DataFrame(
+        {
+            "year": year,
+            "state": pd.Categorical.from_codes(state_codes, states),
+            "age": age,
+            "rate": rate.round(2),
+        }
+    ).astype(DTYPES)
+
+
+def synthetic_raw(n_rows, seed=0):
+    # The same rows as ingest.py reads them from Rate.csv, with family plans
+    # and the 9999+ placeholder rates that preprocess_df drops
+    rates = synthetic_rates(n_rows, seed)
+    rng = np.random.default_rng(seed + 1)
+    labels = ["0-20", *map(str, AGES[1:-1]), "65 and over", "Family Option"]
+    age_codes = rates.age.to_numpy() - AGES[0]
+    age_codes[rng.random(n_rows) < 0.05] = len(labels) - 1
+    rate = rates.rate.to_numpy(dtype=np.float64).round(2)
+    rate[rng.random(n_rows) < 0.01] = 999999
+
+    return pd.DataFrame(
+        {
+            "BusinessYear": rates.year,
+            "StateCode": rates.state,
+            "Age": pd.Categorical.from_codes(age_codes, labels),
+            "IndividualRate": rate,
+        }
+    )
@@ -0,0 +1,65 @@
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from data_loader import shared_array
+
+
+def pack_codes(codes, n_values):
+    # One packed bitmap of the rows holding each code
+    bitmaps = np.empty((n_values, (len(codes) + 7) // 8), dtype=np.uint8)
+    for code in range(n_values):
+        bitmaps[code] = np.packbits(codes == code)
+    return bitmaps
+
+
+def selection_key(selection):
+    # A hashable, order independent form of a selection, dropping the
+    # columns that are not filtered
+    return tuple(
+        (column, tuple(sorted(values)))
+        for column, values in sorted(selection.items())
+        if values is not None
+    )
+
+
+def selection_version(version, selection):
+    digest = hashlib.blake2b(repr(selection_key(selection)).encode(), digest_size=4)
+    return f"{version}-{digest.hexdigest()}"
+
+
+class BitmapIndex:
+    # A packed bitmap of the rows holding each value of each column, so a
+    # selection of values resolves to rows with a few bitwise ORs and ANDs
+    # over n/8 bytes rather than comparing every row
+
+    def __init__(self, rates, columns, version):
+        self.n_rows = len(rates)
+        self.values = {}
+        self.bitmaps = {}
+        for column in columns:
+            codes, values = pd.factorize(rates[column], sort=True)
+            self.values[column] = pd.Index(values)
+            self.bitmaps[column] = shared_array(
+                f"bitmaps-{column}",
+                version,
+                lambda: pack_codes(codes, len(values)),
+            )
+
+    def select(self, selection):
+        # Packed bitmap of the rows whose value in every filtered column is
+        # one of the selected values; a column mapped to None is not filtered
+        selected = np.full((self.n_rows + 7) // 8, 0xFF, dtype=np.uint8)
+        for column, values in selection.items():
+            if values is None:
+                continue
+            positions = self.values[column].get_indexer(list(values))
+            bitmaps = self.bitmaps[column][positions[positions >= 0]]
+            np.bitwise_and(
+                selected, np.bitwise_or.reduce(bitmaps, axis=0), out=selected
+            )
+        return selected
+
+    def rows(self, selection):
+        return np.flatnonzero(np.unpackbits(self.select(selection), count=self.n_rows))
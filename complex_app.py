@@ -8,6 +8,8 @@ from plotly import graph_objects as go
 from plotly import io as pio
 from pprint import pprint
 
+from figures import PLOTLYJS
+
 np.random.seed(19680801)
 
 
@@ -65,7 +67,7 @@ async def serve(q: Q):
         "showLink": q.client.plotly_controls,
         "displayModeBar": q.client.plotly_controls,
     }
-    html = pio.to_html(fig, validate=False, include_plotlyjs="cdn", config=config)
+    html = pio.to_html(fig, validate=False, include_plotlyjs=PLOTLYJS, config=config)
 
     q.page["plot"].content = html
 
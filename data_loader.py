@@ -0,0 +1,255 @@
+import fcntl
+import glob
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+from pyarrow import parquet as pq
+
+RATES_CSV = "data/rate_sample_preprocessed_200k.csv"
+# Either a preprocessed CSV, an .arrow file or a directory written by ingest.py
+RATES_PATH = os.environ.get("RATES_PATH", RATES_CSV)
+
+# Directory, such as /dev/shm, where the first process to load a dataset
+# publishes its columns and derived arrays for every other process to map,
+# so several app or render processes share one copy in memory
+SHARED_DIR = os.environ.get("RATES_SHARED_DIR")
+
+RAW_COLUMNS = ["BusinessYear", "StateCode", "Age", "IndividualRate"]
+AGE_LABELS = {"0-20": "20", "65 and over": "65"}
+
+# Compact dtypes for the preprocessed columns
+DTYPES = {
+    "year": "int16",
+    "state": "category",
+    "age": "int8",
+    "rate": "float32",
+}
+
+# Rows are stored sorted by these columns and then by rate, so every group of
+# a prefix of them is one contiguous slice, in ascending rate order for the
+# full grouping
+LAYOUT_COLUMNS = ("state", "age", "year")
+LAYOUT = ",".join([*LAYOUT_COLUMNS, "rate"])
+
+_loaded = {}
+_lock = threading.Lock()
+
+
+def preprocess_df(df):
+    df = df.loc[:, RAW_COLUMNS]
+    df.columns = ["year", "state", "age", "rate"]
+
+    # Drop family plans and all outlier plans
+    df = df[(df.age != "Family Option") & (df.rate < 9999)]
+
+    # Turn all values in age column to ints, converting each distinct label
+    # once rather than every row
+    age = df.age.astype("category").cat.remove_unused_categories()
+    labels = age.cat.categories.map(lambda label: AGE_LABELS.get(label, label))
+    ages = pd.to_numeric(labels).to_numpy()
+    df = df.assign(age=ages[age.cat.codes.to_numpy()])
+
+    return df.astype(DTYPES)
+
+
+def arrow_path(path):
+    if SHARED_DIR:
+        # Named after the whole source path so datasets never collide
+        name = os.path.basename(os.path.splitext(path.rstrip(os.sep))[0])
+        digest = hashlib.blake2b(path.encode(), digest_size=4).hexdigest()
+        return os.path.join(SHARED_DIR, f"{name}-{digest}.arrow")
+    return os.path.splitext(path.rstrip(os.sep))[0] + ".arrow"
+
+
+@contextmanager
+def publish_lock(path):
+    # Held across processes while one of them writes path
+    with open(path + ".lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def parquet_parts(path):
+    return sorted(glob.glob(os.path.join(path, "*.parquet")))
+
+
+def is_stale(src, dst):
+    if not os.path.exists(dst):
+        return True
+    # Written before the rows were laid out by group, or from other files.
+    # Comparing the files rather than modification times also catches a
+    # file moved over the source with an older mtime.
+    metadata = feather.read_table(dst, memory_map=True).schema.metadata or {}
+    if metadata.get(b"layout") != LAYOUT.encode():
+        return True
+    return metadata.get(b"source") != files_version(src).encode()
+
+
+def convert_csv(csv_path, out_path=None):
+    out_path = out_path or arrow_path(csv_path)
+    # Taken before reading, so files changed meanwhile are converted again
+    source = files_version(csv_path)
+    df = pd.read_csv(csv_path, usecols=list(DTYPES), dtype=DTYPES)
+    write_arrow(df, out_path, source)
+    return out_path
+
+
+def convert_parquet(parts_dir, out_path=None):
+    out_path = out_path or arrow_path(parts_dir)
+    source = files_version(parts_dir)
+    df = pq.read_table(parts_dir).to_pandas()
+    write_arrow(df.loc[:, list(DTYPES)].astype(DTYPES), out_path, source)
+    return out_path
+
+
+def sort_rates(df):
+    return df.sort_values([*LAYOUT_COLUMNS, "rate"], ignore_index=True)
+
+
+def write_arrow(df, out_path, source=None):
+    # Uncompressed and in one record batch so every column maps straight to
+    # a numpy array without decoding or concatenating, written to a
+    # temporary name first so readers never see a partial file. source is
+    # the files_version of the files the rows came from.
+    table = pa.Table.from_pandas(sort_rates(df), preserve_index=False)
+    metadata = {**table.schema.metadata, b"layout": LAYOUT.encode()}
+    if source is not None:
+        metadata[b"source"] = source.encode()
+    table = table.replace_schema_metadata(metadata)
+    tmp_path = out_path + ".tmp"
+    feather.write_feather(
+        table,
+        tmp_path,
+        compression="uncompressed",
+        chunksize=max(len(df), 1),
+    )
+    os.replace(tmp_path, out_path)
+
+
+def read_arrow(path):
+    table = feather.read_table(path, memory_map=True)
+    # split_blocks keeps the numeric columns as zero-copy views of the mapping
+    return table.to_pandas(split_blocks=True)
+
+
+def files_version(path):
+    # Names, sizes and modification times of the files, so telling versions
+    # of a dataset apart never has to read it
+    digest = hashlib.blake2b(digest_size=8)
+    for name in parquet_parts(path) if os.path.isdir(path) else [path]:
+        info = os.stat(name)
+        digest.update(
+            f"{os.path.basename(name)} {info.st_size} {info.st_mtime_ns}".encode()
+        )
+    return digest.hexdigest()
+
+
+def load_rates(path=RATES_PATH):
+    # Loaded once per version of the files; every caller gets the same
+    # frame, so treat it as read-only
+    path = os.path.abspath(path)
+    with _lock:
+        stamp = files_version(path)
+        if _loaded.get(path, (None,))[0] != stamp:
+            # Dropped first, so the old version can be freed while the new
+            # one loads
+            _loaded.pop(path, None)
+            if path.endswith(".arrow"):
+                source = path
+            else:
+                source = arrow_path(path)
+                with publish_lock(source):
+                    if is_stale(path, source):
+                        if os.path.isdir(path):
+                            convert_parquet(path, source)
+                        else:
+                            convert_csv(path, source)
+            _loaded[path] = stamp, read_arrow(source)
+        return _loaded[path][1]
+
+
+def group_offsets(rates):
+    # Rows of each group of the layout columns, as a table of start and stop
+    # positions indexed by group, or None if the rows are not laid out by
+    # sort_rates
+    if not len(rates):
+        return None
+    columns = [rates[column] for column in LAYOUT_COLUMNS]
+    codes = [
+        (
+            column.cat.codes.to_numpy()
+            if isinstance(column.dtype, pd.CategoricalDtype)
+            else column.to_numpy()
+        )
+        for column in columns
+    ]
+    changed = np.zeros(len(rates), dtype=bool)
+    changed[0] = True
+    for code in codes:
+        changed[1:] |= code[1:] != code[:-1]
+    starts = np.flatnonzero(changed)
+
+    # Every group in one run, the runs in key order and the rates of each
+    # in ascending order
+    order = np.lexsort([code[starts] for code in reversed(codes)])
+    if not np.array_equal(order, np.arange(len(starts))):
+        return None
+    rate = rates.rate.to_numpy()
+    if not np.all((rate[1:] >= rate[:-1]) | changed[1:]):
+        return None
+
+    index = pd.MultiIndex.from_arrays(
+        [column.array.take(starts) for column in columns], names=LAYOUT_COLUMNS
+    )
+    stops = np.append(starts[1:], len(rates))
+    return pd.DataFrame({"start": starts, "stop": stops}, index=index)
+
+
+def dataset_version(rates):
+    # Content hash of the columns, read straight from the memory-mapped data
+    digest = hashlib.blake2b(digest_size=8)
+    for column in DTYPES:
+        values = rates[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            digest.update(",".join(values.cat.categories).encode())
+            values = values.cat.codes
+        digest.update(memoryview(values.to_numpy()))
+    return digest.hexdigest()
+
+
+def shared_array(name, version, compute):
+    # compute() once per dataset version across every process using
+    # SHARED_DIR, which then maps the same read-only copy; without
+    # SHARED_DIR just compute()
+    if not SHARED_DIR:
+        return compute()
+
+    path = os.path.join(SHARED_DIR, f"{name}-{version}.npy")
+    with publish_lock(path):
+        if not os.path.exists(path):
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, compute())
+            os.replace(tmp_path, path)
+    return np.load(path, mmap_mode="r")
+
+
+def release_shared(version):
+    # Unlinks the arrays published for a dataset version no longer served;
+    # processes still mapping them keep them until they let go
+    if not SHARED_DIR:
+        return
+    for path in glob.glob(os.path.join(SHARED_DIR, f"*-{version}.npy*")):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,271 @@
+import hashlib
+import os
+from functools import cached_property
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+from aggregates import (
+    GROUP_COLUMNS,
+    MAX_OUTLIERS,
+    MAX_RATE_BINS,
+    QUANTILES,
+    RATE_BINS,
+    SKETCH_DIR,
+    RateCube,
+)
+from bitmaps import selection_key, selection_version
+from data_loader import DTYPES, files_version
+from sketches import read_sketches
+
+# DuckDB spills to disk rather than grow past this
+DUCKDB_MEMORY_LIMIT = os.environ.get("DUCKDB_MEMORY_LIMIT", "1GB")
+
+STATS_SQL = """
+SELECT
+    {keys},
+    count(*) AS count,
+    sum(rate) AS sum,
+    avg(rate) AS mean,
+    quantile_cont(rate, [0.25, 0.5, 0.75]) AS quartiles,
+    min(rate) AS min,
+    max(rate) AS max,
+    stddev_samp(rate) AS std
+FROM {table}
+GROUP BY {keys}
+ORDER BY {keys}
+"""
+
+FENCES_SQL = """
+SELECT
+    {key},
+    min(rate) FILTER (WHERE rate >= low) AS lowerfence,
+    max(rate) FILTER (WHERE rate <= high) AS upperfence
+FROM {table} JOIN limits USING ({key})
+GROUP BY {key}
+"""
+
+# A fixed pseudo-random sample of each group's outliers
+OUTLIERS_SQL = """
+SELECT {key}, rate
+FROM {table} JOIN limits USING ({key})
+WHERE rate < low OR rate > high
+QUALIFY row_number() OVER (PARTITION BY {key} ORDER BY hash(rate)) <= {max_outliers}
+"""
+
+# No quantiles, so it streams the files without holding their rates
+BOUNDS_SQL = """
+SELECT
+    list(DISTINCT state ORDER BY state) AS states,
+    min(year) AS min_year,
+    max(year) AS max_year,
+    min(age) AS min_age,
+    max(age) AS max_age
+FROM {table}
+"""
+
+RATE_BINS_SQL = """
+SELECT least(floor((rate - {low}) / {width}), {n_bins} - 1)::INTEGER AS bin,
+    count(*) AS count
+FROM {table}
+GROUP BY bin
+"""
+
+
+def source_sql(path):
+    # A dataset directory written by ingest.py, a parquet file or a
+    # preprocessed CSV
+    if os.path.isdir(path):
+        return f"read_parquet('{os.path.join(path, '*.parquet')}')"
+    if path.endswith(".parquet"):
+        return f"read_parquet('{path}')"
+    if path.endswith(".csv"):
+        return f"read_csv('{path}')"
+    raise ValueError(f"DuckDB cannot query {path}")
+
+
+def sql_literal(value):
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(int(value))
+
+
+class DuckDBCube(RateCube):
+    # RateCube over files on disk: each statistic is a DuckDB query that
+    # streams the files, so the rates are never loaded into memory. Medians
+    # and quartiles are exact unless QUANTILES is approximate and the
+    # dataset has sketches. where filters the rows with SQL, through a view
+    # on the parent cube's database when there is one.
+
+    def __init__(self, path, quantiles=QUANTILES, where=None, parent=None):
+        path = os.path.abspath(path)
+        sketches = None
+        sketch_dir = os.path.join(path, SKETCH_DIR)
+        # Sketches describe the whole dataset, not a filtered part of it
+        if quantiles == "approximate" and os.path.isdir(sketch_dir) and not where:
+            sketches = read_sketches(sketch_dir)
+        else:
+            quantiles = "exact"
+        super().__init__(
+            None, quantiles, sketches, version=files_version(path), shared=False
+        )
+
+        self.path = path
+        if parent is None:
+            self.table = "rates"
+            self.connection = duckdb.connect()
+            self.connection.execute(f"SET memory_limit = '{DUCKDB_MEMORY_LIMIT}'")
+            source = source_sql(path)
+        else:
+            # One database for every selection, so its memory limit bounds
+            # them all together
+            digest = hashlib.blake2b(where.encode(), digest_size=8).hexdigest()
+            self.table = f"rates_{digest}"
+            self.connection = parent.connection
+            source = parent.table
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE OR REPLACE VIEW {self.table} AS "
+                "SELECT year, state, age, rate, 0 AS overall "
+                f"FROM {source}" + (f" WHERE {where}" if where else "")
+            )
+
+    def query(self, sql, **tables):
+        # A cursor per query, since one DuckDB connection is not safe to use
+        # from several threads
+        with self.connection.cursor() as cursor:
+            for name, table in tables.items():
+                cursor.register(name, table)
+            return cursor.execute(sql).df()
+
+    def rate_stats(self, by):
+        # One query per grouping, since exact quantiles hold every rate of
+        # the groups being aggregated in memory
+        keys = list(by) or ["overall"]
+        result = self.query(STATS_SQL.format(table=self.table, keys=", ".join(keys)))
+        quartiles = np.stack(result.pop("quartiles").to_numpy())
+        result.insert(result.columns.get_loc("min"), "median", quartiles[:, 1])
+        result["q1"] = quartiles[:, 0]
+        result["q3"] = quartiles[:, 2]
+
+        if not by:
+            return result.drop(columns="overall").set_index(pd.Index([None]))
+        result = result.astype({column: DTYPES[column] for column in by})
+        return result.set_index(list(by))
+
+    def compute_stats(self, by):
+        if self.quantiles == "approximate":
+            return super().compute_stats(by)
+        return self.rate_stats(by)
+
+    def compute_box(self, by):
+        if self.quantiles == "approximate":
+            return super().compute_box(by)
+        return self.box_summary(by)
+
+    # Statistics of every row together
+    @cached_property
+    def overall(self):
+        return self.compute_stats(())
+
+    def box_summary(self, by=None, max_outliers=MAX_OUTLIERS):
+        stats = self.get(by) if by else self.overall
+        key = by or "overall"
+        iqr = stats.q3 - stats.q1
+        limits = pd.DataFrame(
+            {
+                key: stats.index.astype(str) if by == "state" else stats.index,
+                "low": (stats.q1 - 1.5 * iqr).to_numpy(),
+                "high": (stats.q3 + 1.5 * iqr).to_numpy(),
+            }
+        )
+        if by is None:
+            limits[key] = 0
+
+        fences = self.query(FENCES_SQL.format(table=self.table, key=key), limits=limits)
+        outliers = self.query(
+            OUTLIERS_SQL.format(table=self.table, key=key, max_outliers=max_outliers),
+            limits=limits,
+        )
+        fences = fences.set_index(key).reindex(limits[key])
+        samples = outliers.groupby(key).rate.agg(list).reindex(limits[key])
+
+        rows = []
+        for i, (_, group) in enumerate(stats.iterrows()):
+            low, high = limits.low[i], limits.high[i]
+            sample = samples.iloc[i] if isinstance(samples.iloc[i], list) else []
+            # Keep the extremes so the axis range matches the full data
+            extremes = [x for x in (group["min"], group["max"]) if x < low or x > high]
+            rows.append(
+                {
+                    "q1": group.q1,
+                    "median": group["median"],
+                    "q3": group.q3,
+                    "lowerfence": fences.lowerfence.iloc[i],
+                    "upperfence": fences.upperfence.iloc[i],
+                    "mean": group["mean"],
+                    "outliers": np.unique(np.append(sample, extremes)),
+                }
+            )
+        return pd.DataFrame(rows, index=stats.index.rename(by))
+
+    @cached_property
+    def bounds(self):
+        row = self.query(BOUNDS_SQL.format(table=self.table)).iloc[0]
+        return (
+            list(row.states),
+            (int(row.min_year), int(row.max_year)),
+            (int(row.min_age), int(row.max_age)),
+        )
+
+    @cached_property
+    def histograms(self):
+        histograms = {"rate": self.rate_histogram()}
+        for column in GROUP_COLUMNS:
+            counts = self.get(column)["count"]
+            if column == "state":
+                x, width = counts.index.astype(str).to_numpy(), None
+            else:
+                # Every value between the extremes, as bincount gives
+                x = np.arange(counts.index.min(), counts.index.max() + 1)
+                counts, width = counts.reindex(x, fill_value=0), 1
+            histograms[column] = pd.DataFrame(
+                {"x": x, "width": width, "count": counts.to_numpy()}
+            )
+        return histograms
+
+    def selected_cube(self, selection):
+        # Filtered in SQL, so nothing is indexed in memory
+        where = " AND ".join(
+            f"{column} IN ({', '.join(map(sql_literal, values))})"
+            for column, values in selection_key(selection)
+        )
+        cube = DuckDBCube(self.path, "exact", where, parent=self)
+        cube.version = selection_version(self.version, selection)
+        empty = cube.query(f"SELECT count(*) AS n FROM {cube.table}").n[0] == 0
+        return None if empty else cube
+
+    def rate_histogram(self, bins=RATE_BINS):
+        # The same edges np.histogram_bin_edges gives, from the overall
+        # statistics rather than the rates
+        overall = self.overall.iloc[0]
+        low, high = overall["min"], overall["max"]
+        match bins:
+            case int():
+                n_bins = bins
+            case "fd":
+                width = 2 * (overall.q3 - overall.q1) * overall["count"] ** (-1 / 3)
+                n_bins = int(np.ceil((high - low) / width)) if width else 1
+            case _:
+                raise ValueError(f"DuckDBCube cannot compute {bins} bins")
+        n_bins = max(min(n_bins, MAX_RATE_BINS), 1)
+        edges = np.linspace(low, high, n_bins + 1)
+        width = (high - low) / n_bins or 1
+
+        result = self.query(
+            RATE_BINS_SQL.format(table=self.table, low=low, width=width, n_bins=n_bins)
+        )
+        counts = np.zeros(n_bins, dtype=np.int64)
+        counts[result.bin.to_numpy()] = result["count"].to_numpy()
+        return pd.DataFrame({"x": edges[:-1], "width": np.diff(edges), "count": counts})
@@ -0,0 +1,179 @@
+import argparse
+import html
+import importlib.util
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from plotly import io as pio
+
+from aggregates import open_cube
+from assets import plotlyjs_name, write_plotlyjs
+from data_loader import RATES_PATH
+from figures import encode_figure
+from render import CHARTS, CHOICES, init_worker, render_version, worker_cube
+
+EXPORT_DIR = os.environ.get("EXPORT_DIR", "data/export")
+FORMATS = ("html", "png", "svg")
+# Written by kaleido, which drives a headless Chrome
+IMAGE_FORMATS = ("png", "svg")
+IMAGE_WIDTH, IMAGE_HEIGHT = 1000, 600
+# What every exported file was rendered from, so unchanged ones are skipped
+MANIFEST = "manifest.json"
+
+
+def file_name(chart, choice, fmt):
+    return f"{chart}-{choice}.{fmt}"
+
+
+def write_atomic(path, write):
+    # Written to a temporary name first so readers never see a partial file
+    tmp_path = path + ".tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def write_text(path, text):
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            f.write(text)
+
+    write_atomic(path, write)
+
+
+def export_figure(cube, chart, choice, formats, out_dir):
+    # Builds the figure once and writes it in every format
+    fig = CHARTS[chart](cube, choice)
+    for fmt in formats:
+        path = os.path.join(out_dir, file_name(chart, choice, fmt))
+        if fmt == "html":
+            # The plotly.js bundle sits beside the pages, so they open offline
+            page = pio.to_html(
+                encode_figure(fig), validate=False, include_plotlyjs=plotlyjs_name()
+            )
+            write_text(path, page)
+        else:
+            write_atomic(
+                path,
+                lambda tmp: pio.write_image(
+                    fig, tmp, format=fmt, width=IMAGE_WIDTH, height=IMAGE_HEIGHT
+                ),
+            )
+    return chart, choice, formats
+
+
+def export_in_worker(chart, choice, formats, out_dir):
+    return export_figure(worker_cube(), chart, choice, formats, out_dir)
+
+
+def read_manifest(out_dir):
+    path = os.path.join(out_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)["files"]
+
+
+def write_manifest(out_dir, files):
+    write_text(os.path.join(out_dir, MANIFEST), json.dumps({"files": files}))
+
+
+def index_page(version, files):
+    sections = []
+    for chart, choices in CHOICES.items():
+        items = []
+        for choice in choices:
+            names = {
+                fmt: file_name(chart, choice, fmt)
+                for fmt in FORMATS
+                if file_name(chart, choice, fmt) in files
+            }
+            links = " ".join(
+                f'<a href="{html.escape(name)}">{fmt.upper()}</a>'
+                for fmt, name in names.items()
+            )
+            preview = names.get("png") or names.get("svg")
+            image = f'<img src="{html.escape(preview)}" width="400">' if preview else ""
+            items.append(
+                f"<li><h3>{html.escape(choice)}</h3>{image}<p>{links}</p></li>"
+            )
+        sections.append(f"<h2>{html.escape(chart)}</h2><ul>{''.join(items)}</ul>")
+
+    return (
+        "<!DOCTYPE html><html><head><meta charset='utf-8'>"
+        "<title>Health insurance rates</title></head><body>"
+        f"<h1>Health insurance rates</h1><p>Dataset {html.escape(version)}, "
+        f"exported {time.strftime('%Y-%m-%d %H:%M')}</p>{''.join(sections)}"
+        "</body></html>"
+    )
+
+
+def export(path=RATES_PATH, out_dir=EXPORT_DIR, formats=FORMATS, workers=None):
+    # Renders every chart and choice across a process pool, skipping files
+    # already exported from the same data and plotting code. Returns the
+    # numbers of figures exported and skipped.
+    os.makedirs(out_dir, exist_ok=True)
+    version = open_cube(path).version
+    stamp = f"{version}-{render_version()}"
+    files = read_manifest(out_dir)
+
+    tasks = []
+    for chart, choices in CHOICES.items():
+        for choice in choices:
+            pending = [
+                fmt
+                for fmt in formats
+                if files.get(file_name(chart, choice, fmt)) != stamp
+                or not os.path.exists(
+                    os.path.join(out_dir, file_name(chart, choice, fmt))
+                )
+            ]
+            if pending:
+                tasks.append((chart, choice, pending))
+
+    if tasks:
+        if "html" in formats:
+            write_plotlyjs(out_dir)
+        with ProcessPoolExecutor(
+            workers, initializer=init_worker, initargs=(path,)
+        ) as pool:
+            done = pool.map(export_in_worker, *zip(*tasks), [out_dir] * len(tasks))
+            for chart, choice, written in done:
+                for fmt in written:
+                    files[file_name(chart, choice, fmt)] = stamp
+        write_manifest(out_dir, files)
+
+    write_text(os.path.join(out_dir, "index.html"), index_page(version, files))
+    n_figures = sum(map(len, CHOICES.values()))
+    return len(tasks), n_figures - len(tasks)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export every dashboard chart to static files with an index page"
+    )
+    parser.add_argument("--data", default=RATES_PATH)
+    parser.add_argument("--out", default=EXPORT_DIR)
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=FORMATS)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    images = set(args.formats) & set(IMAGE_FORMATS)
+    if images and importlib.util.find_spec("kaleido") is None:
+        parser.error(
+            f"{' and '.join(sorted(images))} need kaleido: pip install kaleido, "
+            "or export --formats html"
+        )
+
+    start = time.perf_counter()
+    exported, skipped = export(args.data, args.out, args.formats, args.workers)
+    elapsed = time.perf_counter() - start
+    print(
+        f"Exported {exported} figures to {args.out} in {elapsed:.1f}s, "
+        f"{skipped} unchanged"
+    )
+
+
+if __name__ == "__main__":
+    main()
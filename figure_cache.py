@@ -0,0 +1,58 @@
+import threading
+from collections import OrderedDict
+
+
+class FigureCache:
+    # Least-recently-used cache of rendered figures, bounded by total size.
+    # Keys should include the dataset version so new data never hits stale
+    # entries.
+
+    def __init__(self, max_bytes=64 * 2**20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        # Rendered HTML is ASCII, so its length is its size in bytes
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = value
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def evict(self, predicate):
+        # Drops every entry whose key matches, e.g. those of a dataset
+        # version that is no longer served
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self.size -= len(self.entries.pop(key))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,373 @@
+import base64
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+from plotly import graph_objects as go
+from plotly import io as pio
+from plotly.offline import get_plotlyjs_version
+from plotly.utils import PlotlyJSONEncoder
+
+from assets import plotlyjs_url
+
+# Where chart frames load plotly.js from: "cdn", "local" for the versioned
+# copy written by assets.py, or any URL ending in .js
+PLOTLYJS = os.environ.get("PLOTLYJS", "cdn")
+if PLOTLYJS == "local":
+    PLOTLYJS = plotlyjs_url()
+
+# "compact" rounds to cents, downcasts and base64-encodes numeric arrays and
+# dictionary-encodes repeated categories; "plain" leaves figures as built
+FIGURE_ENCODING = os.environ.get("FIGURE_ENCODING", "compact")
+# Base64 typed arrays in figure JSON need plotly.js 2.28 or later
+TYPED_ARRAYS = tuple(map(int, get_plotlyjs_version().split(".")[:2])) >= (2, 28)
+TYPED_ARRAY_CODES = {
+    np.dtype(name): code
+    for name, code in [
+        ("int8", "i1"),
+        ("uint8", "u1"),
+        ("int16", "i2"),
+        ("uint16", "u2"),
+        ("int32", "i4"),
+        ("uint32", "u4"),
+        ("float32", "f4"),
+        ("float64", "f8"),
+    ]
+}
+TYPED_ARRAY_DTYPES = {code: dtype for dtype, code in TYPED_ARRAY_CODES.items()}
+# Shorter arrays are not worth encoding
+MIN_ENCODED_LENGTH = 8
+# Trace types that draw numeric positions the same as categorical ones
+CATEGORY_TRACES = ("bar", "box", "scatter")
+
+MARGIN = dict(l=0, r=0, t=30, b=0)
+# Plotly express' first default colour, so server-side summaries match px
+TRACE_COLOR = "#636efa"
+
+
+def to_html(fig):
+    return pio.to_html(encode_figure(fig), validate=False, include_plotlyjs=PLOTLYJS)
+
+
+def to_json(fig):
+    # Data and layout only, for updating a figure already on the page. The
+    # template is left out since the page keeps the one it was drawn with.
+    fig_dict = encode_figure(fig)
+    fig_dict["layout"].pop("template", None)
+    return json.dumps(fig_dict, cls=PlotlyJSONEncoder)
+
+
+def encode_figure(fig, encoding=None):
+    fig_dict = fig.to_dict()
+    if (encoding or FIGURE_ENCODING) == "compact":
+        encode_categories(fig_dict)
+        for trace in fig_dict["data"]:
+            for key, values in trace.items():
+                values = decode_array(values)
+                if is_numeric_array(values):
+                    trace[key] = compact_array(values)
+    return fig_dict
+
+
+def decode_array(values):
+    # Newer plotly versions already hold numpy arrays as typed array specs
+    if isinstance(values, dict) and "bdata" in values and "shape" not in values:
+        dtype = TYPED_ARRAY_DTYPES[values["dtype"]].newbyteorder("<")
+        return np.frombuffer(base64.b64decode(values["bdata"]), dtype=dtype)
+    return values
+
+
+def is_numeric_array(values):
+    if not isinstance(values, (list, tuple, np.ndarray)):
+        return False
+    values = np.asarray(values)
+    return (
+        values.ndim == 1
+        and len(values) >= MIN_ENCODED_LENGTH
+        and (values.dtype.kind in "iuf")
+    )
+
+
+def compact_array(values):
+    values = np.asarray(values)
+    if values.dtype.kind == "f":
+        # Rates are dollars, so cents are all the precision worth sending
+        values = values.round(2)
+        narrowed = values.astype(np.float32)
+        if np.array_equal(narrowed.astype(np.float64).round(2), values, equal_nan=True):
+            values = narrowed
+    else:
+        values = values.astype(
+            np.result_type(
+                np.min_scalar_type(values.min()), np.min_scalar_type(values.max())
+            )
+        )
+
+    code = TYPED_ARRAY_CODES.get(values.dtype)
+    if not TYPED_ARRAYS or code is None:
+        return values
+    data = values.astype(values.dtype.newbyteorder("<"), copy=False).tobytes()
+    return {"dtype": code, "bdata": base64.b64encode(data).decode()}
+
+
+def encode_categories(fig_dict):
+    # Replace category labels on the x axis with integer positions when some
+    # trace repeats them many times, e.g. the outliers of a box plot, and
+    # label the positions with ticks instead. Hover labels read the ticks
+    # too, so they still show the categories.
+    traces = [
+        trace
+        for trace in fig_dict["data"]
+        if trace.get("xaxis", "x") == "x" and trace.get("x") is not None
+    ]
+    labels = [np.asarray(decode_array(trace["x"])) for trace in traces]
+    if not labels or any(values.dtype.kind not in "OUS" for values in labels):
+        return
+    if any(trace.get("type") not in CATEGORY_TRACES for trace in traces):
+        return
+
+    xaxis = fig_dict["layout"].setdefault("xaxis", {})
+    # Plotly orders categories by first appearance unless told otherwise
+    categories = xaxis.get("categoryarray")
+    if categories is None:
+        categories = pd.unique(np.concatenate(labels))
+    # One label per category, as in line and bar charts, is not worth it
+    if max(map(len, labels)) < 2 * len(categories):
+        return
+
+    positions = pd.Index(categories)
+    for trace, values in zip(traces, labels):
+        trace["x"] = positions.get_indexer(values)
+    xaxis.update(
+        type="linear",
+        tickmode="array",
+        tickvals=list(range(len(categories))),
+        ticktext=list(categories),
+    )
+
+
+def approximate_note(cube):
+    # Marks titles of charts drawn from approximate medians and quartiles
+    if cube.quantile_error:
+        return f" (quantiles within {cube.quantile_error * 100:g}%)"
+    return ""
+
+
+def no_rates():
+    # Drawn in place of a chart when the filters select no rows
+    fig = go.Figure()
+    fig.update_layout(
+        title="No rates match the filters",
+        xaxis_visible=False,
+        yaxis_visible=False,
+        margin=MARGIN,
+    )
+    return fig
+
+
+def histogram(cube, column):
+    match column:
+        case "rate":
+            return hist_rate(cube)
+        case "age":
+            return hist_age(cube)
+        case "state":
+            return hist_state(cube)
+        case "year":
+            return hist_year(cube)
+
+
+# Bars from the cube's precomputed bins rather than raw rows
+def hist_bars(bins, column, title):
+    fig = go.Figure(
+        go.Bar(
+            x=bins["x"],
+            y=bins["count"],
+            width=bins["width"] if column == "rate" else None,
+            offset=0 if column == "rate" else None,
+            marker_color=TRACE_COLOR,
+            name="count",
+        )
+    )
+    fig.update_layout(
+        title=title, xaxis_title=column, yaxis_title="count", bargap=0, margin=MARGIN
+    )
+    return fig
+
+
+def hist_rate(cube):
+    title = "Count Histogram of Rate"
+    fig = hist_bars(cube.histogram("rate"), "rate", title)
+    fig.update_yaxes(type="log")
+    return fig
+
+
+def hist_age(cube):
+    title = "Count Histogram of Age"
+    return hist_bars(cube.histogram("age"), "age", title)
+
+
+def hist_year(cube):
+    title = "Count Histogram of Year"
+    bins = cube.histogram("year")
+    fig = hist_bars(bins.assign(x=bins["x"].astype(str)), "year", title)
+    fig.update_layout(bargap=0.2)
+    return fig
+
+
+def hist_state(cube):
+    ordering = cube.state_count_order
+
+    title = "Count Histogram of State"
+    bins = cube.histogram("state").set_index("x").loc[ordering].reset_index()
+    fig = hist_bars(bins, "state", title)
+
+    fig.update_layout(
+        xaxis={
+            "tickmode": "array",
+            "tickvals": list(range(len(ordering))),
+            "ticktext": ordering,
+        },
+    )
+    return fig
+
+
+# Mean and median rate for a column
+def mean_and_median_lines(cube, column):
+    stats = cube.get(column)
+
+    # Sort by median for state
+    if column == "state":
+        ordering = cube.state_order
+        stats = stats.loc[ordering]
+
+    df_plot = pd.DataFrame(data={"median": stats["median"], "mean": stats["mean"]})
+
+    fig = px.line(
+        df_plot,
+        labels={"value": "rate"},
+        title=f"Mean and Median Rate by {column.title()}" + approximate_note(cube),
+    )
+    fig.update_layout(margin=MARGIN)
+    if column == "state":
+        fig.update_layout(
+            xaxis={
+                "tickvals": list(range(len(ordering))),
+                "ticktext": ordering,
+            }
+        )
+    elif column == "year":
+        fig.update_layout(xaxis={"tickvals": [2014, 2015, 2016]})
+    return fig
+
+
+# Box traces from precomputed statistics, with only a capped sample of the
+# outliers as points, so the figure size does not grow with the row count
+def summary_box(summary):
+    by = summary.index.name
+    # A single box sits at 0, with its outliers, rather than at its name
+    x = summary.index.tolist() if by is not None else [0]
+    fig = go.Figure(
+        go.Box(
+            x=x,
+            q1=summary["q1"],
+            median=summary["median"],
+            q3=summary["q3"],
+            lowerfence=summary["lowerfence"],
+            upperfence=summary["upperfence"],
+            mean=summary["mean"],
+            boxpoints=False,
+            name="rate",
+            marker_color=TRACE_COLOR,
+        )
+    )
+
+    counts = summary["outliers"].map(len).to_numpy()
+    outlier_x = np.repeat(x, counts)
+    fig.add_trace(
+        go.Scatter(
+            x=outlier_x,
+            y=np.concatenate(summary["outliers"].tolist()),
+            mode="markers",
+            name="outliers",
+            marker=dict(color=TRACE_COLOR, size=4),
+        )
+    )
+    fig.update_layout(showlegend=False, xaxis_title=by, yaxis_title="rate")
+    if by is None:
+        fig.update_xaxes(showticklabels=False)
+    return fig
+
+
+def boxplot(cube, x="none", summary=True):
+    if x == "state":
+        return boxplot_state(cube, summary)
+
+    title = f"Distribution of Rate"
+    if x != "none":
+        title += f" Grouped by {x.title()}"
+    title += approximate_note(cube)
+
+    if summary:
+        fig = summary_box(cube.box(x if x != "none" else None))
+        fig.update_layout(title=title)
+    else:
+        fig = px.box(
+            cube.rates,
+            y="rate",
+            x=x if x != "none" else None,
+            title=title,
+        )
+    fig.update_layout(margin=MARGIN)
+    return fig
+
+
+def boxplot_state(cube, summary=True):
+    # In ascending median order
+    median_ordering = cube.state_order
+
+    title = "Distribution of Rate Grouped by State" + approximate_note(cube)
+    if summary:
+        fig = summary_box(cube.box("state").loc[median_ordering])
+        fig.update_layout(title=title)
+    else:
+        fig = px.box(
+            cube.rates,
+            y="rate",
+            x="state",
+            category_orders={"state": median_ordering},
+            title=title,
+        )
+
+    fig.update_layout(
+        margin=MARGIN,
+        xaxis={
+            "tickmode": "array",
+            "tickvals": list(range(len(median_ordering))),
+            "ticktext": median_ordering,
+            "tickfont_size": 9,
+        },
+    )
+    return fig
+
+
+def usa_map(cube, statistic):
+    rate_by_state = cube.get("state")[statistic]
+
+    title = f"{statistic.title()} Rate" if statistic != "std" else "Standard Deviation"
+    title = title + " by State"
+    if statistic == "median":
+        title += approximate_note(cube)
+    fig = px.choropleth(
+        locationmode="USA-states",
+        locations=rate_by_state.index,
+        scope="usa",
+        color=rate_by_state,
+        color_continuous_scale="reds",
+        title=title,
+    )
+    fig.update_layout(margin=MARGIN)
+    fig.layout.coloraxis.colorbar.title = "Rate ($)"
+    return fig
@@ -0,0 +1,181 @@
+import argparse
+import io
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import pyarrow as pa
+from pyarrow import parquet as pq
+
+from aggregates import GROUP_COLUMNS, GROUPINGS, SKETCH_DIR
+from data_loader import RAW_COLUMNS, preprocess_df
+from sketches import SKETCH_ALPHA, RateSketch, write_sketches
+
+# Read the raw columns compactly; Age stays a category so its handful of
+# labels are converted once per chunk
+RAW_DTYPES = {
+    "BusinessYear": "int16",
+    "StateCode": "category",
+    "Age": "category",
+    "IndividualRate": "float64",
+}
+
+
+class ByteRange(io.RawIOBase):
+    # Read-only view of the bytes [start, end) of a file
+
+    def __init__(self, path, start, end):
+        self.file = open(path, "rb")
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.file.read(min(len(buffer), self.remaining))
+        buffer[: len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def split_file(path, n_ranges):
+    # Byte ranges that start and end on line boundaries, skipping the header.
+    # Assumes no quoted field in Rate.csv contains a newline.
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        header = f.readline()
+        bounds = [f.tell()]
+        for i in range(1, n_ranges):
+            f.seek(max(bounds[-1], size * i // n_ranges))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+        bounds.append(size)
+
+    columns = header.decode().strip().split(",")
+    ranges = [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+    return columns, ranges
+
+
+def ingest_range(path, columns, start, end, out_path, chunksize, alpha):
+    rows_read = rows_written = 0
+    writer = None
+    sketch = None
+    with io.BufferedReader(ByteRange(path, start, end)) as f:
+        chunks = pd.read_csv(
+            f,
+            header=None,
+            names=columns,
+            usecols=RAW_COLUMNS,
+            dtype=RAW_DTYPES,
+            chunksize=chunksize,
+        )
+        for chunk in chunks:
+            rows_read += len(chunk)
+            df = preprocess_df(chunk)
+            # Plain strings on disk, the loader restores the categorical
+            table = pa.Table.from_pandas(
+                df.astype({"state": str}), preserve_index=False
+            )
+            if writer is None:
+                writer = pq.ParquetWriter(out_path, table.schema)
+            writer.write_table(table)
+            rows_written += len(df)
+
+            # A quantile sketch of the finest grouping, merged chunk by chunk;
+            # the coarser ones are rolled up from it once at the end
+            chunk_sketch = RateSketch.from_rates(df, GROUP_COLUMNS, alpha)
+            sketch = chunk_sketch if sketch is None else sketch.merge(chunk_sketch)
+
+    if writer is not None:
+        writer.close()
+    return rows_read, rows_written, sketch
+
+
+def ingest(path, out_dir, workers=None, chunksize=250_000, alpha=SKETCH_ALPHA):
+    workers = workers or os.cpu_count()
+    os.makedirs(out_dir, exist_ok=True)
+    for old_part in os.listdir(out_dir):
+        if old_part.endswith(".parquet"):
+            os.remove(os.path.join(out_dir, old_part))
+
+    # A few ranges per worker keeps every core busy until the end
+    columns, ranges = split_file(path, workers * 4)
+    rows_read = rows_written = 0
+    sketch = None
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [
+            pool.submit(
+                ingest_range,
+                path,
+                columns,
+                start,
+                end,
+                os.path.join(out_dir, f"part-{i:05d}.parquet"),
+                chunksize,
+                alpha,
+            )
+            for i, (start, end) in enumerate(ranges)
+        ]
+        for future in as_completed(futures):
+            read, written, range_sketch = future.result()
+            rows_read += read
+            rows_written += written
+            if range_sketch is not None:
+                sketch = range_sketch if sketch is None else sketch.merge(range_sketch)
+
+    sketches = {}
+    if sketch is not None:
+        sketches = {by: sketch.rollup(by) for by in [(), *GROUPINGS]}
+        write_sketches(sketches, os.path.join(out_dir, SKETCH_DIR))
+    sketch_bytes = sum(map(RateSketch.nbytes, sketches.values()))
+    return rows_read, rows_written, sketch_bytes
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the preprocessed rates dataset from the raw Rate.csv"
+    )
+    parser.add_argument("raw_csv", nargs="?", default="data/Rate.csv")
+    parser.add_argument("out_dir", nargs="?", default="data/rates")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunksize", type=int, default=250_000)
+    parser.add_argument(
+        "--alpha",
+        type=float,
+        default=SKETCH_ALPHA,
+        help="relative error of the approximate quantiles",
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    rows_read, rows_written, sketch_bytes = ingest(
+        args.raw_csv, args.out_dir, args.workers, args.chunksize, args.alpha
+    )
+    elapsed = time.perf_counter() - start
+
+    print(f"Read {rows_read:,} rows, wrote {rows_written:,} to {args.out_dir}")
+    print(
+        f"Quantile sketches within {args.alpha:.1%} in {SKETCH_DIR}, "
+        f"{sketch_bytes / 2**20:.1f} MB in memory"
+    )
+    print(f"Elapsed {elapsed:.1f}s ({rows_read / elapsed:,.0f} rows/sec)")
+    print(
+        f"Peak RSS: main {peak_rss_mb(resource.RUSAGE_SELF):.0f} MB, "
+        f"largest worker {peak_rss_mb(resource.RUSAGE_CHILDREN):.0f} MB"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,164 @@
-from h2o_wave import main, app, Q, ui, on, handle_on
+import asyncio
+import logging
+import os
+import time
 
-import pandas as pd
-import numpy as np
-import plotly.express as px
-from plotly import io as pio
+from h2o_wave import main, app, Q, ui, on, handle_on
 
-MARGIN = dict(l=0, r=0, t=30, b=0)
+from aggregates import filter_bounds, filter_selection, open_cube
+from api import serve_api
+from assets import plotlyjs_url, write_plotlyjs
+from bitmaps import selection_key
+from data_loader import release_shared
+from figures import PLOTLYJS
+from figure_cache import FigureCache
+from metrics import METRICS, SIZE_BUCKETS, serve_metrics
+from reload import RELOAD_SECONDS, DatasetWatcher
+from render import all_figures, make_executor, render_call
+from warmup import FIGURE_BUNDLE_DIR, load_bundle
+
+# Rendered HTML shared by every client, keyed by chart, choice and dataset
+FIGURE_CACHE = FigureCache(int(os.environ.get("FIGURE_CACHE_BYTES", 64 * 2**20)))
+
+# Figures are built off the event loop so one slow render does not stall
+# every other client. RENDER_POOL is "thread" or "process".
+RENDER_EXECUTOR = make_executor(
+    os.environ.get("RENDER_POOL", "thread"),
+    int(os.environ.get("RENDER_WORKERS", 0)) or None,
+)
+
+# Prometheus metrics are served on METRICS_PORT when it is set, and
+# summarised in a card on the page when METRICS_CARD is
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+METRICS_CARD = os.environ.get("METRICS_CARD", "") not in ("", "0", "false")
+# The JSON API is served on API_PORT alongside the app when it is set
+API_PORT = int(os.environ.get("API_PORT", 0))
+# Clients that sent an event this recently count as active
+ACTIVE_SECONDS = 5 * 60
+
+_init_lock = asyncio.Lock()
+_last_seen = {}
+
+log = logging.getLogger(__name__)
+
+
+@METRICS.collect
+def collect_gauges(metrics):
+    stats = FIGURE_CACHE.stats()
+    metrics.set("figure_cache_entries", stats["entries"])
+    metrics.set("figure_cache_bytes", stats["bytes"])
+    metrics.set("active_clients", len(_last_seen))
+
+
+def mark_seen(url):
+    # Records a client's event and forgets clients that went quiet, so the
+    # pages are only those of active clients whether or not metrics are on
+    now = time.monotonic()
+    _last_seen[url] = now
+    cutoff = now - ACTIVE_SECONDS
+    for seen_url, seen in list(_last_seen.items()):
+        if seen < cutoff:
+            _last_seen.pop(seen_url, None)
+
+
+def load_cube():
+    with METRICS.timer("stage_seconds", stage="load"):
+        return open_cube()
+
+
+def warm_cube(cube):
+    with METRICS.timer("stage_seconds", stage="aggregate"):
+        return cube.warm()
+
+
+async def init_app(q: Q):
+    # Load dataframe once, shared by every client
+    async with _init_lock:
+        if not q.app.initialized:
+            if METRICS_PORT:
+                serve_metrics(METRICS, METRICS_PORT)
+            if PLOTLYJS == plotlyjs_url():
+                # Make sure the self-hosted plotly.js the frames load exists
+                await q.run(write_plotlyjs)
+            # Watching from before the load, so no change is missed
+            watcher = await q.run(DatasetWatcher)
+            cube = await q.run(load_cube)
+            bundled = await q.run(
+                load_bundle, FIGURE_BUNDLE_DIR, cube.version, FIGURE_CACHE
+            )
+            if bundled:
+                # Every figure is already rendered, so compute the aggregates
+                # in the background rather than before the first page
+                q.app.warmup = asyncio.ensure_future(q.run(warm_cube, cube))
+            else:
+                await q.run(warm_cube, cube)
+            q.app.cube = cube
+            if API_PORT:
+                serve_api(lambda: q.app.cube, API_PORT)
+            if RELOAD_SECONDS:
+                q.app.reloader = asyncio.ensure_future(watch_dataset(q, watcher))
+            q.app.initialized = True
+
+
+async def watch_dataset(q, watcher):
+    # Loads and warms each new version of the dataset in a thread while the
+    # old one keeps serving, then swaps it in
+    while True:
+        await asyncio.sleep(watcher.interval)
+        start = time.perf_counter()
+        try:
+            cube = await q.run(watcher.poll)
+        except Exception:
+            log.exception("Could not reload %s", watcher.path)
+            continue
+        if cube is not None:
+            METRICS.observe(
+                "stage_seconds", time.perf_counter() - start, stage="reload"
+            )
+        # Touched files may hold the same rates
+        if cube is not None and cube.version != q.app.cube.version:
+            await swap_cube(q, cube)
+
+
+async def swap_cube(q, cube):
+    # Every figure a client is likely to ask for first is rendered before
+    # the swap, so the refresh does not wait on them
+    await asyncio.gather(
+        *(
+            render_figure(cube, {}, chart, choice, fmt)
+            for chart, choice in all_figures()
+            for fmt in ("html", "json")
+        )
+    )
+    old, q.app.cube = q.app.cube, cube
+    q.app.warmup = None
+    METRICS.inc("dataset_reloads_total")
+
+    # Only this dataset's figures are dropped; selections' versions extend it
+    FIGURE_CACHE.evict(lambda key: key[3].startswith(old.version))
+    release_shared(old.version)
+
+    # Each active client is asked to send an event, which redraws its page
+    # from the new version
+    cutoff = time.monotonic() - ACTIVE_SECONDS
+    for url, seen in list(_last_seen.items()):
+        if seen < cutoff:
+            _last_seen.pop(url, None)
+            continue
+        page = q.site[url]
+        page["meta"].script = ui.inline_script(
+            f"wave.emit('dataset', 'reloaded', '{cube.version}');"
+        )
+        await page.save()
 
 
 @app("/insurance")
 async def serve(q: Q):
+    if not q.app.initialized:
+        await init_app(q)
+
     if not q.client.initialized:
         q.client.initialized = True
-        # Load dataframe
-        q.app.rates = pd.read_csv("data/rate_sample_preprocessed_200k.csv")
 
         ### Code from last article ###
 
@@ -28,12 +173,35 @@ async def serve(q: Q):
 
 @app("/insurance_full")
 async def serve(q: Q):
+    start = time.perf_counter()
+    # Each client has its own page in the default unicast mode
+    mark_seen(q.page.url)
+    q.client.interaction = "other"
+
+    if not q.app.initialized:
+        await init_app(q)
+
     if not q.client.initialized:
         q.client.initialized = True
-        # Load dataframe
-        q.app.rates = pd.read_csv("data/rate_sample_preprocessed_200k.csv")
+        q.client.interaction = "page"
+        # The client's filters, none to begin with, and the dataset version
+        # its page was drawn from
+        q.client.selection = {}
+        q.client.version = q.app.cube.version
 
         hist_initial_value = "rate"
+        box_initial_value = "none"
+        map_initial_value = "median"
+        line_initial_value = "age"
+
+        # Build the initial charts concurrently
+        hist_html, box_html, map_html, line_html = await asyncio.gather(
+            plot_histograms(q, hist_initial_value),
+            plot_boxplots(q, x=box_initial_value),
+            plot_usa_map(q, map_initial_value),
+            plot_mean_and_median_lines(q, line_initial_value),
+        )
+
         q.page["dropdown_hist"] = ui.form_card(
             box="1 1 5 2",
             items=[
@@ -54,10 +222,9 @@ async def serve(q: Q):
         q.page["hist"] = ui.frame_card(
             box="1 2 5 4",
             title="",
-            content=plot_histograms(q, hist_initial_value),
+            content=hist_html,
         )
 
-        box_initial_value = "none"
         q.page["dropdown_box"] = ui.form_card(
             box="6 1 5 2",
             items=[
@@ -79,10 +246,9 @@ async def serve(q: Q):
         q.page["box"] = ui.frame_card(
             box="6 2 5 4",
             title="",
-            content=plot_boxplots(q, x=box_initial_value),
+            content=box_html,
         )
 
-        map_initial_value = "median"
         q.page["tab_map"] = ui.tab_card(
             box="6 6 5 1",
             items=[
@@ -98,10 +264,9 @@ async def serve(q: Q):
         q.page["map"] = ui.frame_card(
             box="6 7 5 5",
             title="",
-            content=plot_usa_map(q, map_initial_value),
+            content=map_html,
         )
 
-        line_initial_value = "age"
         q.page["routing_line"] = ui.markdown_card(
             box="1 6 5 1",
             title="Line: Choose variable to plot",
@@ -111,20 +276,49 @@ async def serve(q: Q):
         q.page["line"] = ui.frame_card(
             box="1 7 5 5",
             title="",
-            content=plot_mean_and_median_lines(q, line_initial_value),
+            content=line_html,
         )
 
-        await q.page.save()
+        # Charts are created once; later changes are pushed into them by
+        # scripts on the meta card
+        q.page["meta"] = ui.meta_card(box="")
+        if METRICS_CARD:
+            q.page["metrics"] = ui.markdown_card(
+                box="1 12 10 4", title="Metrics", content=""
+            )
+        bounds = await q.run(filter_bounds, q.app.cube)
+        q.page["filters"] = filters_card(bounds, q.client.selection)
+
+        # Each chart's choice, and the version of the cube it was drawn from
+        q.client.shown = dict(
+            hist=hist_initial_value,
+            box=box_initial_value,
+            map=map_initial_value,
+            line=line_initial_value,
+        )
+        q.client.shown_version = dict.fromkeys(q.client.shown, q.client.version)
+        q.client.scripts = []
+        q.client.script_count = 0
+
+    if q.client.version != q.app.cube.version:
+        await reload_client(q)
+    await update_filters(q)
 
     # Update Histogram
     if q.args.choice_hist:
-        q.page["hist"].content = plot_histograms(q, q.args.choice_hist)
+        await update_chart(q, "hist", q.args.choice_hist)
 
     # Update Boxplot
     if q.args.choice_box:
-        q.page["box"].content = plot_boxplots(q, x=q.args.choice_box)
+        await update_chart(q, "box", q.args.choice_box)
 
     await handle_on(q)
+    await save_page(q)
+    METRICS.observe(
+        "request_seconds",
+        time.perf_counter() - start,
+        interaction=q.client.interaction,
+    )
 
 
 # This function is called when q.args['#'] is 'line/age', 'line/state', or 'line/year'.
@@ -133,208 +327,233 @@ async def serve(q: Q):
 # you can also pass these custom URLs like APIs if there are multiple hash selector elements
 @on(arg="#line/{variable}")
 async def handle_line(q: Q, variable: str):
-    q.page["line"].content = plot_mean_and_median_lines(q, variable)
-    await q.page.save()
+    await update_chart(q, "line", variable)
 
 
 @on(arg="#map/{statistic}")
 async def handle_map(q: Q, statistic: str):
-    q.page["map"].content = plot_usa_map(q, statistic)
-    await q.page.save()
-
-
-def preprocess_df(df):
-    cols_we_want = ["BusinessYear", "StateCode", "Age", "IndividualRate"]
-    df = df.loc[:, cols_we_want]
-    df.columns = ["year", "state", "age", "rate"]
-
-    # Turn all values in age column to ints
-    df = df[df.age != "Family Option"]
-    df["age"] = df.age.str.replace("0-20", "20")
-    df["age"] = df.age.str.replace("65 and over", "65")
-    df["age"] = pd.to_numeric(df.age)
-
-    # Drop all outlier plans
-    df = df[df.rate < 9999]
-
-    return df
-
-
-def plot_boxplots(q, x="none"):
-    if x == "state":
-        return plot_boxplot_state(q)
-
-    title = f"Distribution of Rate"
-    if x != "none":
-        title += f" Grouped by {x.title()}"
-
-    fig = px.box(
-        q.app.rates,
-        y="rate",
-        x=x if x != "none" else None,
+    await update_chart(q, "map", statistic)
+
+
+# Swaps new data and layout into the plotly div already inside a chart's
+# frame, keeping the template it was drawn with, instead of replacing the
+# frame's whole document
+REACT_SCRIPT = """
+(function () {
+  const frame = document.querySelector('[data-test="%(card)s"] iframe');
+  const fig = %(fig)s;
+  const react = () => {
+    const win = frame.contentWindow;
+    const div = win.document.querySelector(".plotly-graph-div");
+    fig.layout.template = div.layout.template;
+    win.Plotly.react(div, fig.data, fig.layout);
+  };
+  if (frame.contentWindow.Plotly) {
+    react();
+  } else {
+    frame.addEventListener("load", react, { once: true });
+  }
+})();
+"""
+
+
+def filters_card(bounds, selection, title="Filters"):
+    states, years, ages = bounds
+
+    def chosen(column, full):
+        # The selected range of a column, or all of it
+        values = selection.get(column)
+        if not values:
+            return full
+        return max(min(values), full[0]), min(max(values), full[1])
+
+    years_chosen, ages_chosen = chosen("year", years), chosen("age", ages)
+    return ui.form_card(
+        box="11 1 2 6",
         title=title,
+        items=[
+            ui.dropdown(
+                name="filter_states",
+                label="States",
+                placeholder="All states",
+                values=list(selection.get("state") or []),
+                choices=[ui.choice(state, state) for state in states],
+                trigger=True,
+            ),
+            ui.range_slider(
+                name="filter_years",
+                label="Years",
+                min=years[0],
+                max=years[1],
+                step=1,
+                min_value=years_chosen[0],
+                max_value=years_chosen[1],
+                trigger=True,
+            ),
+            ui.range_slider(
+                name="filter_ages",
+                label="Ages",
+                min=ages[0],
+                max=ages[1],
+                step=1,
+                min_value=ages_chosen[0],
+                max_value=ages_chosen[1],
+                trigger=True,
+            ),
+        ],
     )
-    fig.update_layout(margin=MARGIN)
-    html = pio.to_html(fig, validate=False, include_plotlyjs="cdn")
-    return html
 
 
-def plot_boxplot_state(q):
-    # In ascending median order
-    median_ordering = q.app.rates.groupby("state").median().rate.sort_values().index
-
-    title = "Distribution of Rate Grouped by State"
-    fig = px.box(
-        q.app.rates,
-        y="rate",
-        x="state",
-        category_orders={"state": median_ordering},
-        title=title,
-    )
-
-    fig.update_layout(
-        margin=MARGIN,
-        xaxis={
-            "tickvals": list(range(len(median_ordering))),
-            "ticktext": median_ordering,
-            "tickfont_size": 9,
-        },
+async def update_filters(q):
+    # Wave sends every input's value with each event, so only act when the
+    # selection changed
+    states, years, ages = q.args.filter_states, q.args.filter_years, q.args.filter_ages
+    if states is None and years is None and ages is None:
+        return
+    # Compared before any work, since most events come from other inputs
+    if [states, years, ages] == q.client.filter_args:
+        return
+    q.client.filter_args = [states, years, ages]
+    selection = await q.run(
+        filter_selection,
+        q.app.cube,
+        states or (),
+        years or (None, None),
+        ages or (None, None),
     )
-    html = pio.to_html(fig, validate=False, include_plotlyjs="cdn")
-    return html
-
-
-def plot_usa_map(q, statistic):
-
-    match statistic:
-        case "median":
-            rate_by_state = q.app.rates.groupby("state").median().rate
-        case "max":
-            rate_by_state = q.app.rates.groupby("state").max().rate
-        case "min":
-            rate_by_state = q.app.rates.groupby("state").min().rate
-        case "mean":
-            rate_by_state = q.app.rates.groupby("state").mean().rate
-        case "std":
-            rate_by_state = q.app.rates.groupby("state").std().rate
-
-    title = f"{statistic.title()} Rate" if statistic != "std" else "Standard Deviation"
-    title = title + " by State"
-    fig = px.choropleth(
-        # rate_by_state,
-        locationmode="USA-states",
-        locations=rate_by_state.index,
-        scope="usa",
-        color=rate_by_state,
-        color_continuous_scale="reds",
-        title=title,
+    if selection_key(selection) == selection_key(q.client.selection):
+        return
+
+    cube = await q.run(q.app.cube.select, selection)
+    if cube is None:
+        # Keep showing the last selection that matched anything
+        q.page["filters"].title = "Filters: no rates match"
+        return
+    q.page["filters"].title = "Filters"
+    q.client.selection = selection
+    q.client.interaction = "filter"
+    await update_charts(q)
+
+
+async def update_charts(q):
+    await asyncio.gather(
+        *(update_chart(q, chart, choice) for chart, choice in q.client.shown.items())
     )
-    fig.update_layout(margin=MARGIN)
-    fig.layout.coloraxis.colorbar.title = "Rate ($)"
-    html = pio.to_html(fig, validate=False, include_plotlyjs="cdn")
-
-    return html
-
-
-def plot_histograms(q, column):
-    match column:
-        case "rate":
-            return plot_hist_rate(q)
-        case "age":
-            return plot_hist_age(q)
-        case "state":
-            return plot_hist_state(q)
-        case "year":
-            return plot_hist_year(q)
-
-
-def plot_hist_rate(q):
-    title = "Count Histogram of Rate"
-    fig = px.histogram(q.app.rates, x="rate", log_y=True, title=title)
-    fig.update_layout(margin=MARGIN)
-    html = pio.to_html(fig, validate=False, include_plotlyjs="cdn")
-    return html
-
-
-def plot_hist_age(q):
-    title = "Count Histogram of Age"
-    fig = px.histogram(q.app.rates, x="age", title=title)
-    fig.update_layout(margin=MARGIN)
-    html = pio.to_html(fig, validate=False, include_plotlyjs="cdn")
-    return html
-
-
-def plot_hist_year(q):
-    title = "Count Histogram of Year"
-    year_count = q.app.rates.groupby("year").count()
-    fig = px.histogram(
-        year_count,
-        x=["2014", "2015", "2016"],
-        y="state",
-        labels=dict(state="year", x="year"),
-        title=title,
-    )
-    fig.update_layout(margin=MARGIN)
-    html = pio.to_html(fig, validate=False, include_plotlyjs="cdn")
-    return html
 
 
-def plot_hist_state(q):
-    sorted_state_count = q.app.rates.groupby("state").count().sort_values("rate")
-    ordering = sorted_state_count.index
+async def reload_client(q):
+    # The app has swapped in a new version of the dataset since this
+    # client's last event: redraw its filters and charts from it, dropping
+    # the selection if it no longer matches anything
+    cube = q.app.cube
+    q.client.version = cube.version
+    q.client.interaction = "reload"
+    if await q.run(cube.select, q.client.selection) is None:
+        q.client.selection = {}
+    q.client.filter_args = None
+    bounds = await q.run(filter_bounds, cube)
+    q.page["filters"] = filters_card(bounds, q.client.selection)
+    await update_charts(q)
+
+
+async def update_chart(q, chart, choice):
+    # Skip charts that already show this choice of the current selection
+    version = q.app.cube.selected_version(q.client.selection)
+    shown = (q.client.shown[chart], q.client.shown_version[chart])
+    if shown == (choice, version):
+        return
+    fig_json = await render(q, chart, choice, "json")
+    q.client.shown[chart] = choice
+    q.client.shown_version[chart] = version
+    if q.client.interaction not in ("filter", "reload"):
+        q.client.interaction = chart
+    q.client.scripts.append(REACT_SCRIPT % dict(card=chart, fig=fig_json))
+
+
+async def save_page(q):
+    if q.client.scripts:
+        # The counter makes every script new, so it runs even if identical to
+        # the last one
+        q.client.script_count += 1
+        content = "".join(q.client.scripts) + f"// {q.client.script_count}"
+        q.page["meta"].script = ui.inline_script(content)
+        q.client.scripts = []
+    if METRICS_CARD:
+        q.page["metrics"].content = metrics_markdown()
+    with METRICS.timer("stage_seconds", stage="save"):
+        await q.page.save()
 
-    title = "Count Histogram of State"
-    fig = px.histogram(
-        q.app.rates, x="state", category_orders={"state": ordering}, title=title
-    )
 
-    fig.update_layout(
-        margin=MARGIN,
-        xaxis={
-            "tickmode": "array",
-            "tickvals": list(range(len(ordering))),
-            "ticktext": ordering,
-        },
+def metrics_markdown():
+    stats = FIGURE_CACHE.stats()
+    lookups = stats["hits"] + stats["misses"]
+    hit_rate = stats["hits"] / lookups if lookups else 0
+    lines = [
+        f"Active clients: {len(_last_seen)}, "
+        f"figure cache: {stats['entries']} figures, "
+        f"{stats['bytes'] / 2**20:.1f} MB, {hit_rate:.0%} hits",
+        "",
+        "| Interaction | Requests | Mean (ms) | p95 (ms) |",
+        "| --- | --- | --- | --- |",
+    ]
+    for labels, (count, mean, p95) in METRICS.summary("request_seconds").items():
+        interaction = dict(labels)["interaction"]
+        lines.append(f"| {interaction} | {count} | {mean*1000:.1f} | {p95*1000:.1f} |")
+    return "\n".join(lines)
+
+
+async def render(q, chart, choice, fmt="html"):
+    # From the app's cube on each use rather than one kept per client, so no
+    # client holds on to a cube the app has swapped out
+    return await render_figure(q.app.cube, q.client.selection, chart, choice, fmt)
+
+
+async def render_figure(cube, selection, chart, choice, fmt="html"):
+    # cube is only filtered by selection when the figure is not cached
+    key = (chart, choice, fmt, cube.selected_version(selection))
+    start = time.perf_counter()
+    page = FIGURE_CACHE.get(key)
+    if page is None:
+        METRICS.inc("figure_cache_requests_total", chart=chart, result="miss")
+        func, args = render_call(RENDER_EXECUTOR, cube, chart, choice, fmt, selection)
+        # Not q.exec, which wraps func in a context that process pools
+        # cannot pickle
+        loop = asyncio.get_running_loop()
+        page, build, serialise = await loop.run_in_executor(
+            RENDER_EXECUTOR, func, *args
+        )
+        METRICS.observe("figure_seconds", build, chart=chart, choice=choice)
+        METRICS.observe(
+            "serialise_seconds", serialise, chart=chart, choice=choice, fmt=fmt
+        )
+        FIGURE_CACHE.put(key, page)
+    else:
+        METRICS.inc("figure_cache_requests_total", chart=chart, result="hit")
+
+    # Includes waiting for a free render worker
+    METRICS.observe(
+        "render_seconds",
+        time.perf_counter() - start,
+        chart=chart,
+        choice=choice,
+        fmt=fmt,
     )
-    html = pio.to_html(fig, validate=False, include_plotlyjs="cdn")
-    return html
+    METRICS.observe("payload_bytes", len(page), SIZE_BUCKETS, chart=chart, fmt=fmt)
+    return page
 
 
-# Plot mean and median rate for a column
-def plot_mean_and_median_lines(q, column):
+async def plot_boxplots(q, x="none"):
+    return await render(q, "box", x)
 
-    median = q.app.rates.groupby(column).median().rate
-    mean = q.app.rates.groupby(column).mean().rate
 
-    # Sort by median for state
-    if column == "state":
-        median = median.sort_values()
-        ordering = median.index
-        mean = mean.loc[ordering]
+async def plot_usa_map(q, statistic):
+    return await render(q, "map", statistic)
 
-    input_data = {
-        "median": median,
-        "mean": mean,
-    }
 
-    df_plot = pd.DataFrame(data=input_data)
+async def plot_histograms(q, column):
+    return await render(q, "hist", column)
 
-    fig = px.line(
-        df_plot,
-        labels={"value": "rate"},
-        title=f"Mean and Median Rate by {column.title()}",
-    )
-    fig.update_layout(margin=MARGIN)
-    if column == "state":
-        fig.update_layout(
-            xaxis={
-                "tickvals": list(range(len(q.app.rates[column].unique()))),
-                "ticktext": ordering,
-            }
-        )
-    elif column == "year":
-        fig.update_layout(xaxis={"tickvals": [2014, 2015, 2016]})
-    else:
-        pass
-    html = pio.to_html(fig, validate=False, include_plotlyjs="cdn")
-    return html
+
+# Plot mean and median rate for a column
+async def plot_mean_and_median_lines(q, column):
+    return await render(q, "line", column)
@@ -0,0 +1,69 @@
+import logging
+import os
+import threading
+import time
+
+from aggregates import open_cube
+from data_loader import RATES_PATH, files_version
+
+# Seconds between checks of the dataset's files for a new version; 0 turns
+# reloading off
+RELOAD_SECONDS = float(os.environ.get("RELOAD_SECONDS", 10))
+
+log = logging.getLogger(__name__)
+
+
+class DatasetWatcher:
+    # Watches the files of a dataset and, once they change and then stay
+    # unchanged for a check, opens and warms the new version off the caller's
+    # thread. Swapping it in is left to the caller, or to start.
+
+    def __init__(self, path=RATES_PATH, interval=RELOAD_SECONDS):
+        self.path = path
+        self.interval = interval
+        self.stamp = self.files_version()
+        self.pending = None
+        self.cube = None
+
+    def files_version(self):
+        try:
+            return files_version(self.path)
+        except OSError:
+            # Being replaced right now
+            return None
+
+    def poll(self):
+        # The warmed cube of a new version of the files, or None
+        stamp = self.files_version()
+        if stamp is None or stamp == self.stamp:
+            self.pending = None
+            return None
+        if stamp != self.pending:
+            # Still being written, perhaps
+            self.pending = stamp
+            return None
+
+        cube = open_cube(self.path).warm()
+        self.stamp, self.pending = stamp, None
+        return cube
+
+    def start(self, cube, on_swap):
+        # Keeps self.cube at the latest version in a daemon thread, calling
+        # on_swap(old, new) after each swap
+        self.cube = cube
+        thread = threading.Thread(target=self.run, args=(on_swap,), daemon=True)
+        thread.start()
+        return thread
+
+    def run(self, on_swap):
+        while True:
+            time.sleep(self.interval)
+            try:
+                cube = self.poll()
+            except Exception:
+                log.exception("Could not reload %s", self.path)
+                continue
+            # Touched files may hold the same rates
+            if cube is not None and cube.version != self.cube.version:
+                old, self.cube = self.cube, cube
+                on_swap(old, cube)
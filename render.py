@@ -0,0 +1,136 @@
+import hashlib
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import aggregates
+import figures
+import sketches
+from aggregates import open_cube
+from data_loader import RATES_PATH, files_version
+from figures import to_html, to_json
+
+# Figure builder for each dashboard chart and every choice it offers
+CHARTS = {
+    "hist": figures.histogram,
+    "box": figures.boxplot,
+    "line": figures.mean_and_median_lines,
+    "map": figures.usa_map,
+}
+CHOICES = {
+    "hist": ["rate", "year", "age", "state"],
+    "box": ["none", "age", "state", "year"],
+    "line": ["age", "state", "year"],
+    "map": ["median", "mean", "min", "max", "std"],
+}
+# Serialisers for complete pages and for in-place updates
+FORMATS = {"html": to_html, "json": to_json}
+
+_worker_cube = None
+_worker_path = None
+_worker_stamp = None
+# The worker's cubes by dataset version: the current one and the one before,
+# for renders the app asked for just before it swapped versions
+_worker_cubes = {}
+
+
+def all_figures():
+    return [(chart, choice) for chart, choices in CHOICES.items() for choice in choices]
+
+
+def render_version():
+    # Changes whenever the code that turns data into figures does
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(f"{figures.PLOTLYJS} {figures.FIGURE_ENCODING}".encode())
+    digest.update(f"{aggregates.QUANTILES} {sketches.SKETCH_ALPHA}".encode())
+    for module in (aggregates, figures, sketches):
+        with open(module.__file__, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def build_figure(cube, chart, choice, selection=None):
+    # The chart of the rows of cube that selection selects. When it selects
+    # none the figure says so, rather than charting every row under the
+    # selection's version.
+    selected = cube.select(selection or {})
+    if selected is None:
+        return figures.no_rates()
+    return CHARTS[chart](selected, choice)
+
+
+def render_figure(cube, chart, choice, fmt="html"):
+    return FORMATS[fmt](CHARTS[chart](cube, choice))
+
+
+def render_timed(cube, chart, choice, fmt="html", selection=None):
+    # The page with the seconds spent building and serialising the figure,
+    # returned rather than recorded so timings from process workers are kept
+    start = time.perf_counter()
+    fig = build_figure(cube, chart, choice, selection)
+    built = time.perf_counter()
+    page = FORMATS[fmt](fig)
+    return page, built - start, time.perf_counter() - built
+
+
+def init_worker(path):
+    global _worker_cube, _worker_path, _worker_stamp
+    _worker_stamp = files_version(path)
+    _worker_cube = open_cube(path)
+    _worker_cubes[_worker_cube.version] = _worker_cube
+    _worker_path = path
+
+
+def worker_cube():
+    # The cube init_worker opened in this process
+    return _worker_cube
+
+
+def render_in_worker(chart, choice, fmt="html"):
+    # Process pool workers render from their own copy of the cube
+    return render_figure(_worker_cube, chart, choice, fmt)
+
+
+def versioned_worker_cube(version):
+    # The worker's cube of a dataset version, reopening the files when the
+    # app has moved on to a version the worker has not loaded
+    global _worker_cube, _worker_cubes, _worker_stamp
+    if version not in _worker_cubes:
+        stamp = files_version(_worker_path)
+        if stamp != _worker_stamp:
+            previous = _worker_cube
+            _worker_stamp, _worker_cube = stamp, open_cube(_worker_path)
+            _worker_cubes = {
+                previous.version: previous,
+                _worker_cube.version: _worker_cube,
+            }
+    if version not in _worker_cubes:
+        raise RuntimeError(f"No render worker cube of dataset version {version}")
+    return _worker_cubes[version]
+
+
+def render_timed_in_worker(chart, choice, fmt="html", selection=None, version=None):
+    cube = _worker_cube if version is None else versioned_worker_cube(version)
+    return render_timed(cube, chart, choice, fmt, selection)
+
+
+def make_executor(kind="thread", workers=None, path=RATES_PATH):
+    match kind:
+        case "thread":
+            return ThreadPoolExecutor(workers)
+        case "process":
+            return ProcessPoolExecutor(
+                workers, initializer=init_worker, initargs=(path,)
+            )
+        case _:
+            raise ValueError(f"Unknown executor kind: {kind}")
+
+
+def render_call(executor, cube, chart, choice, fmt="html", selection=None):
+    # The function and arguments to submit to executor for one figure, which
+    # returns the page and its build and serialise times like render_timed.
+    # cube is filtered by selection in the executor, so callers only pay for
+    # it when they render; process workers filter their own copy of the
+    # version of cube, or raise if they cannot load it.
+    if isinstance(executor, ProcessPoolExecutor):
+        return render_timed_in_worker, (chart, choice, fmt, selection, cube.version)
+    return render_timed, (cube, chart, choice, fmt, selection)
@@ -0,0 +1,181 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import parquet as pq
+
+# Approximate quantiles are within SKETCH_ALPHA of the true value, relative
+# to it, so 0.01 means within 1%
+SKETCH_ALPHA = float(os.environ.get("SKETCH_ALPHA", 0.01))
+# Rates at or below this share the lowest bucket
+MIN_RATE = 0.01
+
+# How each moment combines across sketches
+MOMENTS = {"count": "sum", "sum": "sum", "sumsq": "sum", "min": "min", "max": "max"}
+
+
+def gamma(alpha):
+    return (1 + alpha) / (1 - alpha)
+
+
+def bucket_index(values, alpha):
+    # Bucket i holds the values in (gamma^(i-1), gamma^i]
+    logs = np.log(np.maximum(values, MIN_RATE)) / np.log(gamma(alpha))
+    return np.ceil(logs).astype(np.int32)
+
+
+def bucket_value(index, alpha):
+    # The point of bucket i within alpha of everything in it
+    g = gamma(alpha)
+    return 2 * g ** np.asarray(index, dtype=np.float64) / (g + 1)
+
+
+def group_keys(rates, by):
+    if by:
+        return [rates[column] for column in by]
+    # A single group keyed by 0 when there is nothing to group by
+    return [pd.Series(np.zeros(len(rates), dtype=np.int8), rates.index, name="all")]
+
+
+class RateSketch:
+    # Mergeable summary of rate in every group of the by columns: exact
+    # count, sum, sum of squares, min and max, plus counts in logarithmic
+    # buckets (as in DDSketch) from which any quantile is estimated within a
+    # relative error of alpha. Its size depends on the number of groups and
+    # the range of rates, never on the number of rows.
+
+    def __init__(self, by, moments, buckets, alpha=SKETCH_ALPHA):
+        self.by = tuple(by)
+        self.moments = moments
+        self.buckets = buckets
+        self.alpha = alpha
+
+    @classmethod
+    def from_rates(cls, rates, by, alpha=SKETCH_ALPHA):
+        rate = rates.rate.to_numpy().astype(np.float64)
+        keys = group_keys(rates, by)
+        frame = pd.DataFrame(
+            {"rate": rate, "sumsq": rate * rate, "bucket": bucket_index(rate, alpha)},
+            index=rates.index,
+        )
+        grouped = frame.groupby(keys, observed=True)
+        moments = grouped.rate.agg(["count", "sum", "min", "max"])
+        moments.insert(2, "sumsq", grouped.sumsq.sum())
+        buckets = frame.groupby([*keys, frame.bucket], observed=True).size()
+        return cls(by, moments, buckets, alpha)
+
+    def merge(self, other):
+        return merge_sketches([self, other])
+
+    def rollup(self, by):
+        # The same sketch as from_rates builds for by, a subset of this
+        # sketch's columns, from the moments and bucket counts alone
+        if not set(by) <= set(self.by):
+            raise ValueError(f"Cannot roll up {self.by} to {by}")
+        moments = self.moments.reset_index()
+        buckets = self.buckets.rename("count").reset_index()
+        if not by:
+            moments["all"] = buckets["all"] = np.int8(0)
+        keys = list(by) or ["all"]
+        return RateSketch(
+            by,
+            moments.groupby(keys, observed=True).agg(MOMENTS),
+            buckets.groupby([*keys, "bucket"], observed=True)["count"].sum(),
+            self.alpha,
+        )
+
+    def quantile(self, p):
+        # Interpolated between the order statistics either side of the rank,
+        # as the exact statistics are, so estimates stay within alpha
+        total = self.moments["count"]
+        rank = p * (total - 1)
+        lower = np.floor(rank)
+        upper = np.minimum(lower + 1, total - 1)
+        low, high = self.order_statistic(lower), self.order_statistic(upper)
+        estimate = low + (high - low) * (rank - lower)
+        # Never outside the exact extremes
+        return estimate.clip(self.moments["min"], self.moments["max"])
+
+    def order_statistic(self, k):
+        # The point of the bucket holding the k-th smallest rate of each
+        # group, k a Series indexed like moments
+        counts = self.buckets
+        levels = list(range(counts.index.nlevels - 1))
+        cumulative = counts.groupby(level=levels).cumsum().to_numpy()
+        k = k.reindex(counts.index.droplevel(-1)).to_numpy()
+        first = counts[cumulative > k].groupby(level=levels).head(1)
+        return pd.Series(
+            bucket_value(first.index.get_level_values(-1), self.alpha),
+            index=first.index.droplevel(-1),
+        )
+
+    def bucket_values(self):
+        # Bucket points and counts, indexed by group
+        counts = self.buckets
+        return pd.DataFrame(
+            {
+                "value": bucket_value(counts.index.get_level_values(-1), self.alpha),
+                "count": counts.to_numpy(),
+            },
+            index=counts.index.droplevel(-1),
+        )
+
+    def nbytes(self):
+        return int(
+            self.moments.memory_usage(deep=True).sum()
+            + self.buckets.memory_usage(deep=True)
+        )
+
+
+def merge_sketches(sketches):
+    first = sketches[0]
+    for sketch in sketches[1:]:
+        if (sketch.by, sketch.alpha) != (first.by, first.alpha):
+            raise ValueError("Only sketches of the same grouping and alpha merge")
+
+    levels = list(range(first.moments.index.nlevels))
+    moments = pd.concat([s.moments for s in sketches]).groupby(level=levels)
+    buckets = pd.concat([s.buckets for s in sketches]).groupby(level=[*levels, -1])
+    return RateSketch(first.by, moments.agg(MOMENTS), buckets.sum(), first.alpha)
+
+
+def sketch_name(by):
+    return "+".join(by) or "all"
+
+
+def write_sketches(sketches, out_dir):
+    # Two parquet files per grouping, with the grouping and alpha in the
+    # schema metadata
+    os.makedirs(out_dir, exist_ok=True)
+    for by, sketch in sketches.items():
+        metadata = {"sketch": json.dumps({"by": by, "alpha": sketch.alpha})}
+        for part, frame in (
+            ("moments", sketch.moments),
+            ("buckets", sketch.buckets.rename("count").to_frame()),
+        ):
+            table = pa.Table.from_pandas(
+                frame.reset_index(), preserve_index=False
+            ).replace_schema_metadata(metadata)
+            pq.write_table(table, os.path.join(out_dir, f"{sketch_name(by)}.{part}"))
+
+
+def read_sketches(sketch_dir):
+    sketches = {}
+    for name in sorted(os.listdir(sketch_dir)):
+        if not name.endswith(".moments"):
+            continue
+        path = os.path.join(sketch_dir, name.removesuffix(".moments"))
+        moments = pq.read_table(path + ".moments")
+        info = json.loads(moments.schema.metadata[b"sketch"])
+        by = tuple(info["by"])
+        keys = list(by) or ["all"]
+        buckets = pq.read_table(path + ".buckets").to_pandas()
+        sketches[by] = RateSketch(
+            by,
+            moments.to_pandas().set_index(keys),
+            buckets.set_index([*keys, "bucket"])["count"],
+            info["alpha"],
+        )
+    return sketches
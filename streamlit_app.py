@@ -5,6 +5,7 @@ from plotly import io as pio
 import streamlit as st
 
 from streamlit_funcs import (
+    filter_sidebar,
     plot_histograms,
     plot_mean_and_median_lines,
     plot_boxplot,
@@ -20,15 +21,19 @@ st.set_page_config(
 
 st.title(title)
 
-left_col, right_col = st.columns(2)
 
-with left_col:
+# Each chart reruns on its own when its selectbox changes, so only that
+# chart is recomputed and sent to the browser
+@st.fragment
+def histogram_chart():
     choice_hist = st.selectbox(
         "Histogram: Choose variable to plot", ("Rate", "Year", "Age", "State")
     )
-
     plot_histograms(choice_hist)
 
+
+@st.fragment
+def line_chart():
     choice_line = st.selectbox(
         "Line: Choose variable to plot",
         ("age", "state", "year"),
@@ -36,19 +41,36 @@ with left_col:
     )
     plot_mean_and_median_lines(choice_line)
 
-with right_col:
+
+@st.fragment
+def boxplot_chart():
     choice_boxplot = st.selectbox(
         "Boxplot: Choose variable for x-axis",
         ("none", "age", "state", "year"),
         format_func=lambda x: x.title(),
     )
-
     plot_boxplot(choice_boxplot)
 
+
+@st.fragment
+def map_chart():
     choice_map = st.selectbox(
         "Map: Choose aggregate statistic",
         ("median", "mean", "min", "max", "std"),
         format_func=lambda x: x.title() if x.startswith("m") else "Standard Deviation",
     )
-
     plot_usa_map(choice_map)
+
+
+# Changing a filter reruns the whole page, redrawing every chart
+filter_sidebar()
+
+left_col, right_col = st.columns(2)
+
+with left_col:
+    histogram_chart()
+    line_chart()
+
+with right_col:
+    boxplot_chart()
+    map_chart()
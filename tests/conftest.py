@@ -0,0 +1,8 @@
+import pytest
+
+from benchmarks.synthetic import synthetic_rates
+
+
+@pytest.fixture(scope="module")
+def rates():
+    return synthetic_rates(20_000, seed=1)
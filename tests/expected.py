@@ -0,0 +1,47 @@
+# Statistics computed the plain pandas and numpy way, to test the kernels
+# against
+import numpy as np
+import pytest
+
+from aggregates import GROUPINGS
+
+ALL_GROUPINGS = [(), *GROUPINGS]
+QUARTILES = {"q1": 0.25, "median": 0.5, "q3": 0.75}
+
+
+def pandas_stats(rates, by):
+    # The statistics of rate_stats, from a pandas groupby
+    rate = rates.rate.astype(np.float64)
+    keys = [rates[column] for column in by] or np.zeros(len(rates))
+    grouped = rate.groupby(keys, observed=True)
+    stats = grouped.agg(["count", "sum", "mean", "min", "max", "std"])
+    for name, p in QUARTILES.items():
+        stats[name] = grouped.quantile(p)
+    return stats.reset_index(drop=True)
+
+
+def assert_stats_equal(stats, expected):
+    for column in expected:
+        np.testing.assert_allclose(
+            stats[column].to_numpy(np.float64),
+            expected[column].to_numpy(np.float64),
+            rtol=1e-12,
+            err_msg=column,
+        )
+
+
+def assert_box_matches(rates, summary, by):
+    # The quartiles, fences and outliers of every box of box_summary
+    rate = rates.rate.astype(np.float64)
+    groups = rate.groupby(rates[by] if by else np.zeros(len(rates)), observed=True)
+    for (_, group), (_, box) in zip(groups, summary.iterrows()):
+        values = np.sort(group.to_numpy())
+        for name, p in QUARTILES.items():
+            assert box[name] == pytest.approx(np.quantile(values, p), rel=1e-12)
+        low = box.q1 - 1.5 * (box.q3 - box.q1)
+        high = box.q3 + 1.5 * (box.q3 - box.q1)
+        assert box.lowerfence == values[values >= low].min()
+        assert box.upperfence == values[values <= high].max()
+        outliers = box.outliers
+        assert np.all((outliers < low) | (outliers > high))
+        assert np.isin(outliers, values).all()
@@ -0,0 +1,15 @@
+import pytest
+
+from aggregates import box_summary, rate_stats
+from expected import ALL_GROUPINGS, assert_box_matches, assert_stats_equal, pandas_stats
+
+
+@pytest.mark.parametrize("by", ALL_GROUPINGS)
+def test_rate_stats_match_pandas(rates, by):
+    stats = rate_stats(rates, by)
+    assert_stats_equal(stats.reset_index(drop=True), pandas_stats(rates, by))
+
+
+@pytest.mark.parametrize("by", [None, "state", "age", "year"])
+def test_box_summary_fences_and_outliers(rates, by):
+    assert_box_matches(rates, box_summary(rates, by), by)
@@ -0,0 +1,10 @@
+from api import entity_tag
+
+
+def test_entity_tag():
+    tag = entity_tag("v1", "/stats", "by=state&statistic=median", False)
+    assert tag == entity_tag("v1", "/stats", "statistic=median&by=state", False)
+    assert tag != entity_tag("v2", "/stats", "by=state&statistic=median", False)
+    assert tag != entity_tag("v1", "/stats", "by=age&statistic=median", False)
+    assert tag != entity_tag("v1", "/stats", "by=state&statistic=median", True)
+    assert tag.startswith('"') and tag.endswith('"')
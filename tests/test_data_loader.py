@@ -0,0 +1,19 @@
+import os
+
+from benchmarks.synthetic import synthetic_rates
+from data_loader import arrow_path, is_stale, load_rates
+
+
+def test_older_file_moved_over_source_is_reloaded(tmp_path):
+    path = str(tmp_path / "rates.csv")
+    synthetic_rates(1_000, seed=1).to_csv(path, index=False)
+    assert len(load_rates(path)) == 1_000
+
+    # Older than the .arrow copy, so only its size and name tell it apart
+    older = str(tmp_path / "older.csv")
+    synthetic_rates(500, seed=2).to_csv(older, index=False)
+    os.utime(older, (0, 0))
+    os.replace(older, path)
+    assert is_stale(path, arrow_path(path))
+    assert len(load_rates(path)) == 500
+    assert not is_stale(path, arrow_path(path))
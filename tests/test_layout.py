@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from aggregates import RateCube, box_summary, rate_stats
+from data_loader import group_offsets, sort_rates
+from expected import ALL_GROUPINGS, assert_box_matches, assert_stats_equal, pandas_stats
+
+
+@pytest.fixture(scope="module")
+def laid_out(rates):
+    return sort_rates(rates)
+
+
+@pytest.mark.parametrize("by", ALL_GROUPINGS)
+def test_laid_out_stats_match_pandas(rates, laid_out, by):
+    cube = RateCube(laid_out, "exact", shared=False)
+    assert cube.offsets is not None
+    stats = cube.get(*by)
+    assert_stats_equal(stats.reset_index(drop=True), pandas_stats(rates, by))
+    if by:
+        pd.testing.assert_index_equal(stats.index, rate_stats(rates, by).index)
+
+
+@pytest.mark.parametrize("by", [None, "state"])
+def test_laid_out_box_summary(rates, laid_out, by):
+    summary = box_summary(laid_out, by, offsets=group_offsets(laid_out))
+    assert_box_matches(rates, summary, by)
+
+
+def test_group_offsets_need_the_layout(rates, laid_out):
+    assert group_offsets(rates) is None
+    offsets = group_offsets(laid_out)
+    assert offsets.stop.sum() - offsets.start.sum() == len(laid_out)
+
+
+def test_group_rates_match_mask(rates, laid_out):
+    cube = RateCube(laid_out, "exact", shared=False)
+    for key in [("TX",), ("TX", 30), ("TX", 30, 2015), ("ZZ",)]:
+        mask = np.logical_and.reduce(
+            [
+                rates[column] == value
+                for column, value in zip(cube.offsets.index.names, key)
+            ]
+        )
+        np.testing.assert_array_equal(
+            np.sort(cube.group_rates(*key)), np.sort(rates.rate.to_numpy()[mask])
+        )
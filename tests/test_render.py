@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+import render
+from aggregates import RateCube, open_cube
+from benchmarks.synthetic import synthetic_rates
+
+
+def test_selection_of_nothing_renders_no_rates(rates):
+    cube = RateCube(rates, "exact", shared=False)
+    page, _, _ = render.render_timed(cube, "hist", "rate", "json", {"state": ["ZZ"]})
+    figure = json.loads(page)
+    assert figure["data"] == []
+    assert figure["layout"]["title"]["text"] == "No rates match the filters"
+
+
+def test_worker_renders_only_the_version_asked_for(tmp_path):
+    path = str(tmp_path / "rates.csv")
+    synthetic_rates(1_000, seed=1).to_csv(path, index=False)
+    render.init_worker(path)
+    old = render.worker_cube().version
+    with pytest.raises(RuntimeError):
+        render.render_timed_in_worker("hist", "rate", "json", {}, "other")
+
+    synthetic_rates(500, seed=2).to_csv(path, index=False)
+    new = open_cube(path).version
+    render.render_timed_in_worker("hist", "rate", "json", {}, new)
+    assert render.worker_cube().version == new
+    # Kept for renders the app asked for just before it swapped versions
+    render.render_timed_in_worker("hist", "rate", "json", {}, old)
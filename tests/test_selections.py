@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import aggregates
+from aggregates import RateCube, filter_bounds, selection_bytes
+from data_loader import sort_rates
+from expected import assert_stats_equal, pandas_stats
+
+
+@pytest.mark.parametrize(
+    "selection",
+    [
+        {"state": ["TX", "FL"]},
+        {"age": range(30, 41), "year": [2015]},
+        {"state": ["OH"], "age": [64, 65], "year": None},
+    ],
+)
+def test_selection_matches_mask(rates, selection):
+    cube = RateCube(rates, "exact", shared=False)
+    mask = np.logical_and.reduce(
+        [
+            rates[column].isin(list(values))
+            for column, values in selection.items()
+            if values is not None
+        ]
+    )
+    selected = cube.select(selection)
+    pd.testing.assert_frame_equal(
+        selected.rates.reset_index(drop=True), rates[mask].reset_index(drop=True)
+    )
+    assert_stats_equal(
+        selected.get("state").reset_index(drop=True),
+        pandas_stats(rates[mask], ("state",)),
+    )
+    assert cube.selected_version(selection) == selected.version
+
+
+def test_selection_of_nothing(rates):
+    cube = RateCube(rates, "exact", shared=False)
+    assert cube.select({"state": ["ZZ"]}) is None
+    assert cube.select({}) is cube
+
+
+def test_filter_bounds_match_stats(rates):
+    cube = RateCube(rates, "exact", shared=False)
+    states, years, ages = filter_bounds(cube)
+    assert states == cube.get("state").index.astype(str).tolist()
+    assert years == (cube.get("year").index.min(), cube.get("year").index.max())
+    assert ages == (cube.get("age").index.min(), cube.get("age").index.max())
+
+
+@pytest.mark.parametrize(
+    "selection",
+    [
+        {"state": ["TX"]},
+        {"state": ["TX", "FL"], "age": range(30, 41)},
+        {"age": [64, 65], "year": [2015]},
+    ],
+)
+def test_laid_out_selection_matches_mask(rates, selection):
+    laid_out = sort_rates(rates)
+    cube = RateCube(laid_out, "exact", shared=False)
+    mask = np.logical_and.reduce(
+        [laid_out[column].isin(list(values)) for column, values in selection.items()]
+    )
+    selected = cube.select(selection)
+    pd.testing.assert_frame_equal(
+        selected.rates.reset_index(drop=True), laid_out[mask].reset_index(drop=True)
+    )
+    assert selected.offsets is not None
+    assert cube.selected_version(selection) == selected.version
+
+
+def test_single_run_selection_is_a_view(rates):
+    cube = RateCube(sort_rates(rates), "exact", shared=False)
+    selected = cube.select({"state": ["TX"]})
+    assert np.shares_memory(selected.rates.rate.to_numpy(), cube.rates.rate.to_numpy())
+    assert selection_bytes(selected) == 4 * len(selected.rates)
+
+
+def test_selections_bounded_by_bytes(rates, monkeypatch):
+    cube = RateCube(rates, "exact", shared=False)
+    first = cube.select({"state": ["TX"]})
+    monkeypatch.setattr(aggregates, "SELECTION_CACHE_BYTES", selection_bytes(first))
+    cube.select({"state": ["FL"]})
+    assert len(cube.selections) == 1
+    assert cube.select({"state": ["TX"]}) is not first
@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from aggregates import GROUPINGS
+from expected import ALL_GROUPINGS, QUARTILES, pandas_stats
+from sketches import RateSketch
+
+
+@pytest.mark.parametrize("by", ALL_GROUPINGS)
+@pytest.mark.parametrize("alpha", [0.01, 0.05])
+def test_sketch_quantiles_within_alpha(rates, by, alpha):
+    sketch = RateSketch.from_rates(rates, by, alpha)
+    expected = pandas_stats(rates, by)
+    for name, p in QUARTILES.items():
+        estimate = sketch.quantile(p).to_numpy()
+        exact = expected[name].to_numpy()
+        assert np.all(np.abs(estimate - exact) <= alpha * exact * (1 + 1e-9))
+    moments = sketch.moments.reset_index(drop=True)
+    np.testing.assert_array_equal(moments["count"], expected["count"])
+    np.testing.assert_array_equal(moments["min"], expected["min"])
+    np.testing.assert_array_equal(moments["max"], expected["max"])
+
+
+@pytest.mark.parametrize("by", ALL_GROUPINGS)
+def test_sketch_rollup_matches_from_rates(rates, by):
+    finest = RateSketch.from_rates(rates, GROUPINGS[-1])
+    merged = RateSketch.from_rates(rates[::2], GROUPINGS[-1]).merge(
+        RateSketch.from_rates(rates[1::2], GROUPINGS[-1])
+    )
+    expected = RateSketch.from_rates(rates, by)
+    for sketch in (finest, merged):
+        rolled = sketch.rollup(by)
+        pd.testing.assert_frame_equal(rolled.moments, expected.moments, rtol=1e-12)
+        pd.testing.assert_series_equal(
+            rolled.buckets, expected.buckets, check_names=False
+        )
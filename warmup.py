@@ -0,0 +1,80 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from aggregates import open_cube
+from data_loader import RATES_PATH
+from render import FORMATS, all_figures, init_worker, render_in_worker, render_version
+
+FIGURE_BUNDLE_DIR = os.environ.get("FIGURE_BUNDLE_DIR", "data/figures")
+
+
+def bundle_path(bundle_dir, version):
+    # Bundles are tied to the data, the plotting code and the formats in them
+    formats = "-".join(FORMATS)
+    return os.path.join(
+        bundle_dir, f"figures-{version}-{render_version()}-{formats}.json"
+    )
+
+
+def build_bundle(path=RATES_PATH, workers=None):
+    # Full pages for first visits and JSON for the in-place updates that
+    # every later interaction asks for
+    charts, choices, formats = zip(
+        *((chart, choice, fmt) for chart, choice in all_figures() for fmt in FORMATS)
+    )
+    with ProcessPoolExecutor(
+        workers, initializer=init_worker, initargs=(path,)
+    ) as pool:
+        pages = pool.map(render_in_worker, charts, choices, formats)
+        return {
+            f"{chart}/{choice}/{fmt}": page
+            for chart, choice, fmt, page in zip(charts, choices, formats, pages)
+        }
+
+
+def write_bundle(figures, bundle_dir, version):
+    os.makedirs(bundle_dir, exist_ok=True)
+    path = bundle_path(bundle_dir, version)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": version, "figures": figures}, f)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_bundle(bundle_dir, version, cache):
+    # Seed cache with a bundle written for this dataset, if there is one
+    path = bundle_path(bundle_dir, version)
+    if not os.path.exists(path):
+        return 0
+
+    with open(path) as f:
+        figures = json.load(f)["figures"]
+    for key, page in figures.items():
+        chart, choice, fmt = key.split("/")
+        cache.put((chart, choice, fmt, version), page)
+    return len(figures)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Render every dashboard figure into a bundle the app loads"
+    )
+    parser.add_argument("--data", default=RATES_PATH)
+    parser.add_argument("--out", default=FIGURE_BUNDLE_DIR)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    version = open_cube(args.data).version
+    figures = build_bundle(args.data, args.workers)
+    path = write_bundle(figures, args.out, version)
+    elapsed = time.perf_counter() - start
+    print(f"Wrote {len(figures)} figures to {path} in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()